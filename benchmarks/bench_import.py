@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Startup benchmark of ``import esm_environment``, measured with ``python -X
+importtime``.
+
+Importing the package must not import ``esm_parser`` or ``esm_rcfile`` (they are
+only imported when an environment is built), and the cumulative import time of the
+package is compared against the baseline stored in ``baselines.json``.
+
+Usage::
+
+    python benchmarks/bench_import.py [--update-baseline]
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+BASELINE_KEY = "import_esm_environment_us"
+# Allowed slow-down with respect to the baseline before reporting a regression
+TOLERANCE = 1.5
+# Modules that must not be imported by ``import esm_environment``
+DEFERRED_MODULES = ["esm_parser", "esm_rcfile"]
+
+
+def import_times(repeat=5):
+    """
+    Runs ``python -X importtime -c "import esm_environment"`` ``repeat`` times and
+    returns the best cumulative import time of the package in microseconds, and the
+    names of all the imported modules.
+    """
+    best = None
+    modules = set()
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import esm_environment"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        # Lines look like: "import time:   self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            _, cumulative, module = line[len("import time:"):].split("|")
+            module = module.strip()
+            modules.add(module)
+            if module == "esm_environment":
+                cumulative = int(cumulative)
+                best = cumulative if best is None else min(best, cumulative)
+    return best, modules
+
+
+def load_baselines():
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            return json.load(f)
+    return {}
+
+
+def main(update_baseline=False):
+    cumulative, modules = import_times()
+    print(f"import esm_environment: {cumulative} us")
+
+    failed = False
+    for module in DEFERRED_MODULES:
+        if module in modules:
+            print(f"REGRESSION: {module} is imported by 'import esm_environment'")
+            failed = True
+
+    baselines = load_baselines()
+    if update_baseline:
+        baselines[BASELINE_KEY] = cumulative
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline updated in {BASELINES}")
+    elif BASELINE_KEY in baselines:
+        baseline = baselines[BASELINE_KEY]
+        print(f"baseline: {baseline} us")
+        if cumulative > baseline * TOLERANCE:
+            print(f"REGRESSION: import time is above {TOLERANCE}x the baseline")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(update_baseline="--update-baseline" in sys.argv[1:]))
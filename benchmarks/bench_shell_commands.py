@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Benchmark of ``EnvironmentInfos.get_shell_commands`` against the implementation it
+replaced (regex compiled on every variable and type checks inside the loop), on
+``export_vars`` dictionaries with many entries.
+
+Usage::
+
+    python benchmarks/bench_shell_commands.py [n_exports ...]
+"""
+
+import re
+import sys
+import timeit
+
+from esm_environment import EnvironmentInfos
+
+
+def legacy_get_shell_commands(config):
+    """
+    Copy of the ``get_shell_commands`` implementation before the compiled emitter,
+    kept as the reference for this benchmark.
+    """
+    environment = []
+    if "module_actions" in config:
+        for action in config["module_actions"]:
+            if action.startswith("source"):
+                environment.append(action)
+            else:
+                environment.append(f"module {action}")
+    environment.append("")
+    if "export_vars" in config:
+        for var in config["export_vars"]:
+            if isinstance(config["export_vars"], dict):
+                if isinstance(config["export_vars"][var], dict):
+                    key = var
+                    value = config["export_vars"][key]
+                    environment.append(f"export {key}='{str(value)}'")
+                else:
+                    key = var
+                    value = config["export_vars"][key]
+                    ipattern = r"\[+\(\d+\)+\]$"
+                    if key.endswith("[(list)]"):
+                        key = key.replace("[(list)]", "")
+                        environment.append(f"export {value}")
+                    elif re.search(ipattern, key):
+                        environment.append(
+                            f"export {re.sub(ipattern, '', key)}={str(value)}"
+                        )
+                    else:
+                        environment.append(f"export {key}={str(value)}")
+            else:
+                environment.append("export {str(var)}")
+    environment.append("")
+    if "unset_vars" in config:
+        for var in config["unset_vars"]:
+            environment.append(f"unset {var}")
+    return environment
+
+
+def synthetic_config(n_exports):
+    """
+    Returns an environment config with ``n_exports`` export variables, mixing plain
+    variables, variables with repetition indexes and variables added as lists.
+    """
+    export_vars = {}
+    for i in range(n_exports):
+        kind = i % 3
+        if kind == 0:
+            export_vars[f"VAR_{i}"] = f"value_{i}"
+        elif kind == 1:
+            export_vars[f"VAR_{i}[(1)]"] = f"$VAR_{i - 1}:value_{i}"
+        else:
+            export_vars[f"VAR_{i}=value_{i}[(0)][(list)]"] = f"VAR_{i}=value_{i}"
+    return {
+        "module_actions": ["purge"] + [f"load module_{i}" for i in range(50)],
+        "export_vars": export_vars,
+        "unset_vars": [f"UNSET_{i}" for i in range(50)],
+    }
+
+
+def main(sizes):
+    for n_exports in sizes:
+        config = synthetic_config(n_exports)
+        environment = EnvironmentInfos.__new__(EnvironmentInfos)
+        environment.config = config
+
+        assert environment.get_shell_commands() == legacy_get_shell_commands(config)
+
+        repeat = max(1, 100000 // n_exports)
+        legacy = min(
+            timeit.repeat(lambda: legacy_get_shell_commands(config), number=repeat)
+        ) / repeat
+        compiled = min(
+            timeit.repeat(environment.get_shell_commands, number=repeat)
+        ) / repeat
+        print(
+            f"{n_exports:>8} exports: legacy {legacy * 1e3:8.2f} ms, "
+            f"compiled {compiled * 1e3:8.2f} ms, speed-up {legacy / compiled:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
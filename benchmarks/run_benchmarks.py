@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for ``EnvironmentInfos``.
+
+Measures the wall time (median over ``--runs`` of the best of ``--repeat`` calls)
+and the peak memory (``tracemalloc``)
+of the construction of ``EnvironmentInfos``, ``get_shell_commands`` and the writing
+of the scripts, for synthetic coupled setups of different sizes (see
+``synthetic.py``). The results are compared against the baselines stored in
+``baselines.json``, and the phases slower or using more memory than the allowed
+tolerance are reported as regressions. Phases without a baseline are reported as
+errors too: record the baselines on the reference machine with
+``--update-baseline``, which also stores a description of that machine and of the
+``esm_parser`` used under ``suite_reference``.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py [--scenario NAME ...] [--repeat N]
+                                        [--runs N] [--output results.json]
+                                        [--update-baseline]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic  # noqa: E402
+from esm_environment import EnvironmentInfos  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+BASELINE_KEY = "suite"
+REFERENCE_KEY = "suite_reference"
+# Allowed slow-down and memory increase with respect to the baselines
+TIME_TOLERANCE = 1.5
+# Writing the scripts is dominated by the latency of the file system, that varies
+# several times between runs on shared machines
+PHASE_TIME_TOLERANCES = {"write_scripts": 6.0}
+MEMORY_TOLERANCE = 1.2
+
+# Arguments of ``synthetic.coupled_setup`` for each scenario
+SCENARIOS = {
+    "standalone": {
+        "n_components": 1,
+        "n_choose_blocks": 2,
+        "n_add_export_vars": 10,
+        "depth": 1,
+    },
+    "coupled": {
+        "n_components": 4,
+        "n_choose_blocks": 4,
+        "n_add_export_vars": 100,
+        "depth": 2,
+    },
+    "large_coupled": {
+        "n_components": 16,
+        "n_choose_blocks": 8,
+        "n_add_export_vars": 1000,
+        "depth": 3,
+        "n_module_actions": 100,
+        "n_export_vars": 500,
+    },
+}
+# Number of scripts written in the script-writing phase
+N_SCRIPTS = 100
+
+
+def measure(function, repeat):
+    """
+    Returns the best wall time in milliseconds of ``repeat`` calls to ``function``
+    and the peak memory in KiB allocated during an additional traced call.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"time_ms": round(min(times) * 1e3, 3), "peak_kib": round(peak / 1024, 1)}
+
+
+def run_scenario(scenario, repeat):
+    """
+    Runs all the phases of a ``scenario`` and returns their measurements.
+    """
+    complete_config = synthetic.coupled_setup(**SCENARIOS[scenario])
+    environment = EnvironmentInfos("compiletime", complete_config)
+    scripts = {f"task_{i}": [f"echo task {i}"] for i in range(N_SCRIPTS)}
+    tmp_dir = tempfile.mkdtemp()
+
+    def construction():
+        EnvironmentInfos("compiletime", complete_config)
+
+    def get_shell_commands():
+        environment.get_shell_commands()
+
+    def write_scripts():
+        environment.write_scripts(scripts, directory=tmp_dir)
+
+    try:
+        return {
+            "construction": measure(construction, repeat),
+            "get_shell_commands": measure(get_shell_commands, repeat),
+            "write_scripts": measure(write_scripts, repeat),
+        }
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def aggregate(runs):
+    """
+    Combines the measurements of several runs of a scenario: the median of the
+    times, to be robust against noisy machines, and the largest peak memory.
+    """
+    return {
+        phase: {
+            "time_ms": round(
+                statistics.median(run[phase]["time_ms"] for run in runs), 3
+            ),
+            "peak_kib": max(run[phase]["peak_kib"] for run in runs),
+        }
+        for phase in runs[0]
+    }
+
+
+def compare(results, baselines):
+    """
+    Compares the ``results`` with the ``baselines`` and returns the list of
+    regressions and missing baselines found.
+    """
+    regressions = []
+    for scenario, phases in results.items():
+        for phase, measurement in phases.items():
+            baseline = baselines.get(scenario, {}).get(phase)
+            if not baseline:
+                regressions.append(
+                    f"{scenario}/{phase}: no baseline in {BASELINES} (record it "
+                    f"with --update-baseline)"
+                )
+                continue
+            tolerance = PHASE_TIME_TOLERANCES.get(phase, TIME_TOLERANCE)
+            if measurement["time_ms"] > baseline["time_ms"] * tolerance:
+                regressions.append(
+                    f"{scenario}/{phase}: {measurement['time_ms']} ms "
+                    f"(baseline {baseline['time_ms']} ms)"
+                )
+            if measurement["peak_kib"] > baseline["peak_kib"] * MEMORY_TOLERANCE:
+                regressions.append(
+                    f"{scenario}/{phase}: {measurement['peak_kib']} KiB "
+                    f"(baseline {baseline['peak_kib']} KiB)"
+                )
+    return regressions
+
+
+def reference_setup():
+    """
+    Returns a description of the setup the benchmarks run on, stored with the
+    baselines.
+    """
+    try:
+        import esm_parser
+
+        parser_version = getattr(esm_parser, "__version__", "unknown")
+    except ImportError:
+        parser_version = "not installed"
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "esm_parser": parser_version,
+    }
+
+
+def load_baselines():
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            return json.load(f)
+    return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run (can be repeated). Defaults to all the scenarios.",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="Number of runs of each scenario, combined with their median.",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help=f"Store the results as the new baselines in {BASELINES}.",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for scenario in args.scenario or list(SCENARIOS):
+        results[scenario] = aggregate(
+            [run_scenario(scenario, args.repeat) for _ in range(args.runs)]
+        )
+        for phase, measurement in results[scenario].items():
+            print(
+                f"{scenario:>14} {phase:>20}: {measurement['time_ms']:10.3f} ms "
+                f"{measurement['peak_kib']:10.1f} KiB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    baselines = load_baselines()
+    if args.update_baseline:
+        baselines.setdefault(BASELINE_KEY, {}).update(results)
+        baselines[REFERENCE_KEY] = reference_setup()
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Baselines updated in {BASELINES}")
+        return 0
+
+    regressions = compare(results, baselines.get(BASELINE_KEY, {}))
+    for regression in regressions:
+        print(f"FAILED: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
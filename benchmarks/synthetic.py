@@ -0,0 +1,173 @@
+"""
+Generators of synthetic machine configurations and coupled setups for the
+``esm_environment`` benchmarks.
+"""
+
+
+def machine_config(
+    name="synthetic",
+    n_module_actions=20,
+    n_export_vars=50,
+    n_unset_vars=5,
+    n_selectors=4,
+):
+    """
+    Returns a resolved machine configuration (the ``computer`` section of a
+    ``complete_config``).
+
+    Parameters
+    ----------
+    name : str
+        Name of the machine.
+    n_module_actions : int
+        Number of ``module_actions``.
+    n_export_vars : int
+        Number of ``export_vars``.
+    n_unset_vars : int
+        Number of ``unset_vars``.
+    n_selectors : int
+        Number of selector variables (``selector_<i>: value_<i>``) that the
+        ``choose_`` blocks of the components select on (see
+        ``component_environment``).
+
+    Returns
+    -------
+    config : dict
+        The machine configuration.
+    """
+    config = {
+        "name": name,
+        "sh_interpreter": "/bin/bash",
+        "module_actions": ["purge"] + [
+            f"load module_{i}/1.{i}" for i in range(n_module_actions - 1)
+        ],
+        "export_vars": {
+            f"MACHINE_VAR_{i}": f"/opt/{name}/path_{i}" for i in range(n_export_vars)
+        },
+        "unset_vars": [f"MACHINE_UNSET_{i}" for i in range(n_unset_vars)],
+        # Non-environment keys, as in real machine files
+        "partitions": {
+            f"partition_{i}": {"name": f"p{i}", "cores_per_node": 128}
+            for i in range(20)
+        },
+        "launcher_flags": "-l --kill-on-bad-exit=1",
+    }
+    for selector in range(n_selectors):
+        config[f"selector_{selector}"] = f"value_{selector}"
+    return config
+
+
+def component_environment(
+    component, n_choose_blocks=2, n_add_export_vars=10, depth=1, n_selectors=4
+):
+    """
+    Returns the ``environment_changes`` of a ``component``.
+
+    Parameters
+    ----------
+    component : str
+        Name of the component.
+    n_choose_blocks : int
+        Number of ``choose_computer.selector_<i>`` blocks.
+    n_add_export_vars : int
+        Number of elements of the ``add_export_vars`` list, half of them repeated.
+    depth : int
+        Nesting depth of each ``choose_`` block.
+    n_selectors : int
+        Number of selector variables of the machine (see ``machine_config``). Must
+        be larger than ``n_choose_blocks``.
+
+    Returns
+    -------
+    environment : dict
+        The ``environment_changes`` of the component.
+    """
+    prefix = component.upper()
+    n_distinct = max(1, n_add_export_vars // 2)
+    environment = {
+        "add_module_actions": [f"load {component}_module"],
+        "add_export_vars": [
+            f"{prefix}_VAR_{i % n_distinct}=value" for i in range(n_add_export_vars)
+        ],
+    }
+    for block in range(n_choose_blocks):
+        # Build the nested block from the innermost level outwards
+        branch = {"add_export_vars": {f"{prefix}_CHOOSE_{block}": "yes"}}
+        for level in reversed(range(depth)):
+            selector = (block + level) % n_selectors
+            branch = {
+                f"choose_computer.selector_{selector}": {
+                    f"value_{selector}": branch,
+                    "*": {"add_unset_vars": [f"{prefix}_UNSET_{block}_{level}"]},
+                }
+            }
+        environment.update(branch)
+    return environment
+
+
+def coupled_setup(
+    n_components=4,
+    n_choose_blocks=2,
+    n_add_export_vars=10,
+    depth=1,
+    n_module_actions=20,
+    n_export_vars=50,
+):
+    """
+    Returns a ``complete_config`` of a coupled setup with ``n_components``
+    components running on a synthetic machine.
+
+    Parameters
+    ----------
+    n_components : int
+        Number of components of the setup.
+    n_choose_blocks : int
+        Number of ``choose_`` blocks in the environment of each component.
+    n_add_export_vars : int
+        Number of ``add_export_vars`` of each component.
+    depth : int
+        Nesting depth of the ``choose_`` blocks.
+    n_module_actions : int
+        Number of ``module_actions`` of the machine.
+    n_export_vars : int
+        Number of ``export_vars`` of the machine.
+
+    Returns
+    -------
+    complete_config : dict
+        The configuration of the setup.
+    """
+    n_selectors = n_choose_blocks + depth
+    components = [f"component{i}" for i in range(n_components)]
+    complete_config = {
+        "computer": machine_config(
+            n_module_actions=n_module_actions,
+            n_export_vars=n_export_vars,
+            n_selectors=n_selectors,
+        ),
+        "general": {
+            "setup_name": "synthetic_setup",
+            "models": components,
+            "coupled_setup": True,
+        },
+    }
+    for component in components:
+        complete_config[component] = {
+            "model": component,
+            "version": "1.0",
+            "environment_changes": component_environment(
+                component,
+                n_choose_blocks=n_choose_blocks,
+                n_add_export_vars=n_add_export_vars,
+                depth=depth,
+                n_selectors=n_selectors,
+            ),
+            # Non-environment keys, as in a real experiment configuration
+            "input_files": {
+                f"input_{i}": f"/pool/{component}/input_{i}.nc" for i in range(200)
+            },
+            "namelist_changes": {
+                "namelist.config": {f"option_{i}": i for i in range(200)}
+            },
+        }
+    return complete_config
@@ -4,4 +4,37 @@ __author__ = """Dirk Barbi"""
 __email__ = "dirk.barbi@awi.de"
 __version__ = "5.1.3"
 
-from .esm_environment import *
+import importlib
+import sys
+
+__all__ = ["EnvironmentInfos", "environment_infos"]
+
+
+def __getattr__(name):
+    """
+    Lazily imports the contents of ``esm_environment.esm_environment`` (e.g.
+    ``EnvironmentInfos``) on first access, so that importing the package does not
+    import ``esm_parser`` and its dependencies.
+    """
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(".esm_environment", __name__)
+    # The submodule itself (``esm_environment.esm_environment``)
+    if name == "esm_environment":
+        return module
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise AttributeError(
+            f"module {__name__!r} has no attribute {name!r}"
+        ) from None
+
+
+def __dir__():
+    module = importlib.import_module(".esm_environment", __name__)
+    return sorted(set(globals()) | set(dir(module)))
+
+
+# Module ``__getattr__`` (PEP 562) is only supported from Python 3.7 on
+if sys.version_info < (3, 7):
+    from .esm_environment import *
@@ -0,0 +1,261 @@
+"""
+Caching utilities for ``esm_environment``.
+
+The resolved configurations are stored in the user cache directory (by default
+``~/.cache/esm_environment``, or ``$XDG_CACHE_HOME/esm_environment``). The location
+can be changed with the ``ESM_ENVIRONMENT_CACHE_DIR`` environment variable, and the
+on-disk caches can be disabled completely by setting ``ESM_ENVIRONMENT_NO_CACHE``.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+import uuid
+
+
+def cache_enabled():
+    """
+    Returns ``False`` if the on-disk caches are disabled through the
+    ``ESM_ENVIRONMENT_NO_CACHE`` environment variable.
+    """
+    return not os.environ.get("ESM_ENVIRONMENT_NO_CACHE")
+
+
+def get_cache_dir(*subdirs):
+    """
+    Returns the path to the ``esm_environment`` cache directory, or one of its
+    ``subdirs``. The directory is not created by this function.
+
+    Parameters
+    ----------
+    subdirs : str
+        Subdirectories inside the cache directory.
+
+    Returns
+    -------
+    str :
+        Path to the cache directory.
+    """
+    cache_dir = os.environ.get("ESM_ENVIRONMENT_CACHE_DIR")
+    if not cache_dir:
+        xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        cache_dir = os.path.join(xdg_cache, "esm_environment")
+    return os.path.join(cache_dir, *subdirs)
+
+
+def file_signature(path):
+    """
+    Returns a tuple identifying the current state of the file in ``path``: its
+    absolute path, modification time, size and the hash of its content.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    tuple :
+        ``(path, mtime_ns, size, sha256)``
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
+    return (path, stat.st_mtime_ns, stat.st_size, content_hash)
+
+
+def hash_key(*parts):
+    """
+    Returns a hexadecimal hash that can be used as a file name for the given
+    ``parts`` (any objects with a stable ``repr``).
+    """
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def tree_hash(tree, depth=None):
+    """
+    Returns a hexadecimal hash of the nested dictionaries and tuples of ``tree``, fed
+    to the hash piece by piece instead of building the ``repr`` of the whole tree.
+    The hash is order-sensitive.
+
+    Parameters
+    ----------
+    tree : object
+        Object to hash.
+    depth : int
+        Number of levels of dictionaries and tuples hashed piece by piece. The values
+        below are hashed through their whole ``repr``, which is faster for small
+        values. Defaults to ``None`` (no limit).
+
+    Returns
+    -------
+    str or None :
+        Hexadecimal hash, or ``None`` if any value uses the default ``repr``, which
+        contains its memory address and is not stable between processes.
+    """
+    hasher = hashlib.sha256()
+    if not update_tree_hash(hasher, tree, depth):
+        return None
+    return hasher.hexdigest()
+
+
+def update_tree_hash(hasher, tree, depth=None):
+    """
+    Feeds ``tree`` into ``hasher`` (see ``tree_hash``). Returns ``False`` if it
+    contains a value without a stable ``repr``.
+    """
+    if depth != 0 and isinstance(tree, (dict, tuple)):
+        depth = None if depth is None else depth - 1
+        if isinstance(tree, dict):
+            hasher.update(b"{")
+            for key, value in tree.items():
+                if not (
+                    update_tree_hash(hasher, key, 0)
+                    and update_tree_hash(hasher, value, depth)
+                ):
+                    return False
+            hasher.update(b"}")
+        else:
+            hasher.update(b"(")
+            for value in tree:
+                if not update_tree_hash(hasher, value, depth):
+                    return False
+            hasher.update(b")")
+        return True
+    representation = repr(tree)
+    if " object at 0x" in representation:
+        return False
+    # The separator keeps consecutive values apart
+    hasher.update(representation.encode("utf-8") + b",")
+    return True
+
+
+def read_pickle(path):
+    """
+    Loads a pickled object from ``path``. Returns ``None`` if the file does not
+    exist or cannot be unpickled, so that the caller can fall back to generating
+    the object again.
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def write_pickle(path, obj):
+    """
+    Atomically writes ``obj`` pickled into ``path`` (see ``atomic_write``). Errors are
+    ignored (the cache is an optimization and failing to write it must not stop the
+    caller).
+
+    Returns
+    -------
+    bool :
+        ``True`` if the file was written.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return False
+    return True
+
+
+def atomic_write(path, data):
+    """
+    Atomically writes ``data`` into ``path``. The data is first written to a
+    uniquely-named temporary file in the same directory, which is then renamed to
+    ``path``, so that concurrent threads or processes writing the same file never
+    produce or read half-written files.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+    data : str or bytes
+        Content of the file.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    mode = "wb" if isinstance(data, bytes) else "w"
+    try:
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache with least-recently-used eviction, that keeps track of
+    its hits and misses.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries. When exceeded, the least recently used entry is
+        evicted.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry_key):
+        return entry_key in self._entries
+
+    def get(self, entry_key, default=None):
+        """
+        Returns the value stored for ``entry_key`` and marks it as recently used, or
+        ``default`` if there is no such entry.
+        """
+        try:
+            value = self._entries[entry_key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(entry_key)
+        self.hits += 1
+        return value
+
+    def put(self, entry_key, value):
+        """
+        Stores ``value`` for ``entry_key``, evicting the least recently used entries
+        if the cache is full.
+        """
+        self._entries[entry_key] = value
+        self._entries.move_to_end(entry_key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all the entries and resets the counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Returns a dictionary with the ``hits``, ``misses``, ``maxsize`` and current
+        ``size`` of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "maxsize": self.maxsize,
+            "size": len(self._entries),
+        }
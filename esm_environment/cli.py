@@ -0,0 +1,99 @@
+"""
+Command line interface of ``esm_environment``.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from . import matrix
+
+
+def main(argv=None):
+    """
+    Generates the environments for a matrix of machine files and component versions
+    (see ``matrix.environment_matrix``) and writes them as JSON.
+    """
+    parser = argparse.ArgumentParser(
+        prog="esm_environment_matrix",
+        description=(
+            "Generate the environment commands for every machine file and every "
+            "version of the given components, in parallel."
+        ),
+    )
+    parser.add_argument(
+        "machine_files",
+        nargs="*",
+        help=(
+            "Machine files or directories containing them. Defaults to the "
+            "machines folder of the esm_tools configuration."
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="YAML file with the configuration of the components.",
+    )
+    parser.add_argument(
+        "-r",
+        "--run-or-compile",
+        choices=["compiletime", "runtime"],
+        default="compiletime",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worker processes (defaults to the number of CPUs).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the results to this JSON file instead of the standard output.",
+    )
+    args = parser.parse_args(argv)
+
+    machine_files = args.machine_files
+    if not machine_files:
+        from esm_rcfile import FUNCTION_PATH
+
+        machine_files = [os.path.join(FUNCTION_PATH, "machines")]
+
+    complete_config = None
+    if args.config:
+        import esm_parser
+
+        complete_config = esm_parser.yaml_file_to_dict(args.config)
+
+    results = matrix.environment_matrix(
+        machine_files,
+        complete_config,
+        run_or_compile=args.run_or_compile,
+        processes=args.processes,
+    )
+
+    text = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    # Report the environments that failed
+    failed = 0
+    for machine, models in results.items():
+        for model, versions in models.items():
+            for version, commands in versions.items():
+                if isinstance(commands, dict) and "error" in commands:
+                    failed += 1
+                    print(
+                        f"ERROR: {machine} {model} {version}: {commands['error']}",
+                        file=sys.stderr,
+                    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
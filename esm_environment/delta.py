@@ -0,0 +1,154 @@
+"""
+Differences between two resolved environments, and the commands that turn a shell
+where one of them is loaded into the other (e.g. to run post-processing steps with
+the ``runtime`` environment inside a shell with the ``compiletime`` one).
+
+The module commands, exports and unsets are compared as the ordered sequences in
+which they are written to the scripts:
+
+- If the module commands of the loaded environment are a prefix of the target
+  ones, only the remaining ones are emitted. Otherwise all of them are emitted.
+- When no module command is emitted, only the exports after the longest common
+  prefix of both export sequences are emitted. Otherwise, or if the loaded exports
+  after that prefix set variables exported in the prefix or referenced by the
+  emitted exports, or the loaded environment unsets variables that the target
+  exports, all the exports are emitted, as the module commands or the loaded
+  exports may have overwritten them.
+  Exports extending a variable changed by the loaded environment (e.g.
+  ``PATH=$PATH:...``) keep the additions of the loaded one, as when running the
+  full target commands in that shell.
+- The unsets of the target that are not in effect in the shell are emitted.
+- Variables exported by the loaded environment and not by the target are reported
+  as ``leaked``, and only unset if requested.
+"""
+
+from .esm_environment import export_command
+from .optimize import export_name, referenced_names
+
+
+def environment_delta(loaded, target, unset_leaked=False):
+    """
+    Compares the environment ``loaded`` in a shell with the ``target`` one.
+
+    Parameters
+    ----------
+    loaded : EnvironmentInfos
+        Environment already loaded in the shell.
+    target : EnvironmentInfos
+        Environment to load.
+    unset_leaked : bool
+        Whether to unset the ``leaked`` variables. Defaults to ``False``.
+
+    Returns
+    -------
+    delta : dict
+        - ``module_actions``, ``export_vars``: ``common``, ``added`` and
+          ``removed`` commands with respect to the longest common prefix.
+        - ``unset_vars``: variables ``added`` to and ``removed`` from the unsets.
+        - ``leaked``: variables exported by ``loaded`` and not by ``target``.
+        - ``incremental``: ``False`` if all the module commands are emitted.
+        - ``commands``: the delta commands, laid out as
+          ``EnvironmentInfos.commands``.
+    """
+    loaded_modules = loaded.module_commands()
+    target_modules = target.module_commands()
+    common_modules = common_prefix_length(loaded_modules, target_modules)
+
+    loaded_exports = export_entries(loaded.config)
+    target_exports = export_entries(target.config)
+    common_exports = common_prefix_length(loaded_exports, target_exports)
+
+    loaded_unsets = list(loaded.config.get("unset_vars", []))
+    target_unsets = list(target.config.get("unset_vars", []))
+
+    target_names = {name for name, _ in target_exports}
+    leaked = []
+    for name, _ in loaded_exports:
+        if name not in target_names and name not in target_unsets + leaked:
+            leaked.append(name)
+
+    # Module commands
+    incremental = common_modules == len(loaded_modules)
+    module_commands = target_modules[common_modules if incremental else 0:]
+
+    # Exports
+    first_export = common_exports
+    changed_names = {name for name, _ in loaded_exports[common_exports:]}
+    if module_commands:
+        first_export = 0
+    elif changed_names & {name for name, _ in target_exports[:common_exports]}:
+        first_export = 0
+    elif referenced_names(
+        " ".join(command for _, command in target_exports[common_exports:]),
+        changed_names,
+    ):
+        first_export = 0
+    elif target_names & (set(loaded_unsets) - set(target_unsets)):
+        first_export = 0
+    export_commands = [command for _, command in target_exports[first_export:]]
+    exported_names = {name for name, _ in target_exports[first_export:]}
+
+    # Unsets
+    unsets = [
+        name
+        for name in target_unsets
+        if name not in loaded_unsets or name in exported_names
+    ]
+    if unset_leaked:
+        unsets = leaked + [name for name in unsets if name not in leaked]
+
+    commands = (
+        module_commands
+        + [""]
+        + export_commands
+        + [""]
+        + [f"unset {name}" for name in unsets]
+    )
+
+    return {
+        "module_actions": {
+            "common": target_modules[:common_modules],
+            "added": target_modules[common_modules:],
+            "removed": loaded_modules[common_modules:],
+        },
+        "export_vars": {
+            "common": [command for _, command in target_exports[:common_exports]],
+            "added": [command for _, command in target_exports[common_exports:]],
+            "removed": [command for _, command in loaded_exports[common_exports:]],
+        },
+        "unset_vars": {
+            "added": [name for name in target_unsets if name not in loaded_unsets],
+            "removed": [name for name in loaded_unsets if name not in target_unsets],
+        },
+        "leaked": leaked,
+        "incremental": incremental,
+        "commands": commands,
+    }
+
+
+def export_entries(config):
+    """
+    Returns the ``(name, command)`` of each export of ``config``, in order.
+    """
+    export_vars = config.get("export_vars", {})
+    if isinstance(export_vars, dict):
+        return [
+            (export_name(key, value), export_command(key, value))
+            for key, value in export_vars.items()
+        ]
+    return [
+        (str(var).partition("=")[0], f"export {str(var)}") for var in export_vars
+    ]
+
+
+def common_prefix_length(first, second):
+    """
+    Returns the length of the longest common prefix of the lists ``first`` and
+    ``second``.
+    """
+    length = 0
+    for first_item, second_item in zip(first, second):
+        if first_item != second_item:
+            break
+        length += 1
+    return length
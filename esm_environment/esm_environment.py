@@ -4,13 +4,651 @@ Main module for EsmEnvironment.
 """
 
 import copy
+import json
 import os
 import warnings
 import re
+import shlex
 import sys
 
-import esm_parser
-from esm_rcfile import FUNCTION_PATH
+from . import cache
+from . import frozen
+from . import machines
+from . import setups
+from . import timing
+
+# Suffix of the ``export_vars`` keys added from lists
+LIST_SUFFIX = "[(list)]"
+# Repetition index of the ``export_vars`` keys (e.g. ``VAR[(1)]``)
+INDEX_PATTERN = re.compile(r"\[+\(\d+\)+\]$")
+
+# In-process cache of the environments built with ``EnvironmentInfos(...,
+# memoize=True)``. Use ``ENVIRONMENT_CACHE.info()`` to check its hits and misses
+ENVIRONMENT_CACHE = cache.LRUCache(maxsize=128)
+# Version of the format of the lockfiles (see ``EnvironmentInfos.to_lock``)
+LOCK_VERSION = 1
+# Entries of ``config`` stored in the lockfiles
+LOCK_KEYS = ["module_actions", "export_vars", "unset_vars", "sh_interpreter"]
+
+######################################################################################
+############################### helper functions #####################################
+######################################################################################
+
+
+def project_environment_config(complete_config):
+    """
+    Returns a copy-on-write projection of ``complete_config`` that can be safely
+    modified by ``EnvironmentInfos`` without mutating the caller's dictionary.
+
+    Only the subtrees that ``EnvironmentInfos`` modifies are copied: the ``computer``
+    section, which becomes the environment configuration, and the
+    ``*environment_changes`` of each chapter. Each chapter is shallow-copied, so that
+    keys can be added or removed from it, and any other value is shared with
+    ``complete_config`` (they are only read, e.g. to resolve variables). This makes
+    the cost of the copy scale with the size of the environment, instead of with the
+    size of the whole experiment configuration.
+
+    Parameters
+    ----------
+    complete_config : dict
+        Dictionary containing all the compiled information from the `yaml` files
+        needed for the current `ESM-Tools` operation.
+
+    Returns
+    -------
+    projection : dict
+        The projected configuration.
+    """
+    if not complete_config:
+        return {}
+
+    projection = {}
+    for chapter, chapter_config in complete_config.items():
+        # The computer section is modified in place by ``EnvironmentInfos``
+        if chapter == "computer":
+            projection[chapter] = copy.deepcopy(chapter_config)
+        # Copy only the environment changes of the other chapters
+        else:
+            projection[chapter] = project_chapter(chapter_config)
+
+    return projection
+
+
+def project_chapter(chapter_config):
+    """
+    Returns a shallow copy of ``chapter_config`` where only the
+    ``*environment_changes`` are deep-copied (see ``project_environment_config``).
+    Values that are not dictionaries are returned as they are.
+    """
+    if not isinstance(chapter_config, dict):
+        return chapter_config
+    return {
+        key: copy.deepcopy(value) if is_environment_changes_key(key) else value
+        for key, value in chapter_config.items()
+    }
+
+
+def share_structure(base, new):
+    """
+    Returns ``new`` with every subtree that is equal to the corresponding subtree of
+    ``base`` replaced by the one of ``base``, and with its strings interned. This is
+    used to derive the environments of ensemble members from a base environment
+    (see ``EnvironmentInfos.ensemble``), so that they only allocate memory for their
+    differences.
+
+    The returned structure shares objects with ``base`` and must not be modified
+    in place. ``ExportVar`` keys are reused from ``base`` only if all their fields
+    are equal.
+
+    Parameters
+    ----------
+    base : any
+        Structure to share objects from. If ``None``, the strings of ``new`` are
+        only interned.
+    new : any
+        Structure to share.
+
+    Returns
+    -------
+    any :
+        A structure equal to ``new``.
+    """
+    if base is new:
+        return base
+    if type(new) is str:
+        return base if base == new and type(base) is str else sys.intern(new)
+
+    if isinstance(new, dict):
+        base_items = base if isinstance(base, dict) else {}
+        base_keys = {key: key for key in base_items}
+        shared = {}
+        for key, value in new.items():
+            if isinstance(key, ExportVar):
+                # Reuse the equal record of ``base`` only if it has the same fields,
+                # and only once
+                base_key = base_keys.get(key)
+                if (
+                    isinstance(base_key, ExportVar)
+                    and base_key.to_dict() == key.to_dict()
+                ):
+                    del base_keys[key]
+                    key = base_key
+            elif type(key) is str:
+                key = sys.intern(key)
+            shared[key] = share_structure(base_items.get(key), value)
+        if (
+            type(base) is type(new)
+            and len(base) == len(shared)
+            and all(
+                base_key is key and base_items[key] is value
+                for base_key, (key, value) in zip(base, shared.items())
+            )
+        ):
+            return base
+        return shared
+
+    if isinstance(new, (list, tuple)):
+        base_items = base if type(base) is type(new) else ()
+        shared = [
+            share_structure(base_items[i] if i < len(base_items) else None, value)
+            for i, value in enumerate(new)
+        ]
+        if len(base_items) == len(shared) and all(
+            base_item is item for base_item, item in zip(base_items, shared)
+        ):
+            return base
+        return shared if isinstance(new, list) else type(new)(shared)
+
+    if type(base) is type(new) and base == new:
+        return base
+    return new
+
+
+class ResolvedEnvironment:
+    """
+    Slim container of the entries of a resolved environment configuration used to
+    generate the scripts (see ``EnvironmentInfos.slim``). It supports the mapping
+    operations used on ``EnvironmentInfos.config``, and stores nothing else, so it
+    takes a fraction of the memory of the whole machine configuration.
+
+    Parameters
+    ----------
+    config : dict
+        Resolved environment configuration. Only the entries in ``__slots__`` are
+        kept.
+    """
+
+    __slots__ = ("module_actions", "export_vars", "unset_vars", "sh_interpreter")
+
+    def __init__(self, config=None):
+        for key in self.__slots__:
+            if config and key in config:
+                setattr(self, key, config[key])
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(
+                f"{key} cannot be added to a slim environment, only "
+                f"{', '.join(self.__slots__)}"
+            )
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, ResolvedEnvironment):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"ResolvedEnvironment({self.to_dict()!r})"
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def to_dict(self):
+        """
+        Returns the entries as a dictionary.
+        """
+        return dict(self.items())
+
+
+class ExportVar(str):
+    """
+    Record used as the key of the ``export_vars`` added as lists (see
+    ``EnvironmentInfos.env_list_to_dict``).
+
+    The record is a string equal to the key these variables were historically
+    encoded as (``NAME=value[(index)][(list)]``), so records compare and hash like
+    those keys: the same element added by two components (e.g.
+    ``OMP_NUM_THREADS=1``) is exported only once, repeated elements of a list are
+    kept through their ``index``, and ``esm_parser`` sees plain string keys. The
+    fields of the record are kept in ``__slots__`` so that they do not need to be
+    decoded from the string. Keeping both the string and the fields makes a record
+    larger than the plain key it replaces: it saves the decoding, not memory.
+
+    Parameters
+    ----------
+    name : str
+        Name of the variable.
+    value : str
+        Value of the variable when added, or ``None`` for a bare ``export NAME``.
+    component : str
+        Component whose environment added the variable. It is not part of the
+        comparisons.
+    index : int
+        Occurrence of this same element in the list it was added from.
+    from_list : bool
+        ``True`` if the variable was added as an element of a list, ``False`` if it
+        comes from a dictionary (see ``EnvironmentInfos.exports``).
+    """
+
+    __slots__ = ("name", "value", "component", "index", "from_list")
+
+    def __new__(cls, name, value, component=None, index=0, from_list=True):
+        assignment = name if value is None else f"{name}={value}"
+        if from_list:
+            key = f"{assignment}[({index})]{LIST_SUFFIX}"
+        else:
+            key = f"{name}[({index})]" if index else name
+        record = super().__new__(cls, key)
+        record.name = name
+        record.value = value
+        record.component = component
+        record.index = index
+        record.from_list = from_list
+        return record
+
+    def __getnewargs__(self):
+        return (self.name, self.value, self.component, self.index, self.from_list)
+
+    @classmethod
+    def from_assignment(cls, assignment, component=None, index=0):
+        """
+        Creates a record from an element of an ``add_export_vars`` list (e.g.
+        ``"NAME=value"``).
+        """
+        name, sep, value = str(assignment).partition("=")
+        return cls(name, value if sep else None, component, index)
+
+    @property
+    def assignment(self):
+        """
+        The variable as it is written after ``export`` (``NAME=value``).
+        """
+        if self.value is None:
+            return self.name
+        return f"{self.name}={self.value}"
+
+    def to_dict(self):
+        """
+        Returns the record as a dictionary that can be serialised (e.g. to JSON).
+        """
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        Creates a record from a dictionary returned by ``to_dict``.
+        """
+        return cls(**record)
+
+
+class PlaceholderTemplate:
+    """
+    Substitutes several ``${name}`` placeholders in one pass, using a single
+    precompiled regular expression. A template can be reused for the environments of
+    many components (see ``EnvironmentInfos.substitute_placeholders``).
+
+    Parameters
+    ----------
+    mapping : dict
+        Replacement of each placeholder name (e.g. ``{"model_dir": "/work/fesom"}``
+        replaces ``${model_dir}``).
+    """
+
+    def __init__(self, mapping):
+        self.replacements = {
+            f"${{{name}}}": str(value) for name, value in mapping.items()
+        }
+        # Longer placeholders first, so that none is shadowed by a prefix of it
+        placeholders = sorted(self.replacements, key=len, reverse=True)
+        self.pattern = (
+            re.compile("|".join(re.escape(placeholder) for placeholder in placeholders))
+            if placeholders
+            else None
+        )
+
+    def substitute(self, text):
+        """
+        Returns ``text`` with the placeholders replaced. Values that are not strings
+        are returned unchanged.
+        """
+        if self.pattern is None or not isinstance(text, str) or "${" not in text:
+            return text
+        return self.pattern.sub(lambda match: self.replacements[match.group()], text)
+
+    def substitute_tree(self, tree):
+        """
+        Returns a copy of ``tree`` with the placeholders replaced in all its strings,
+        including the string keys of the dictionaries. ``ExportVar`` keys and other
+        values are kept as they are.
+        """
+        if isinstance(tree, dict):
+            return {
+                key if isinstance(key, ExportVar) else self.substitute(key): (
+                    self.substitute_tree(value)
+                )
+                for key, value in tree.items()
+            }
+        if isinstance(tree, list):
+            return [self.substitute_tree(value) for value in tree]
+        return self.substitute(tree)
+
+
+def write_script(path, header, commands):
+    """
+    Atomically writes a script in ``path`` containing the ``header`` followed by the
+    ``commands``, one per line.
+
+    Parameters
+    ----------
+    path : str
+        Path of the script.
+    header : str
+        Header of the script (see ``EnvironmentInfos.script_header``).
+    commands : list of str
+        Commands to write after the header.
+    """
+    cache.atomic_write(
+        path, header + "".join(f"{command}\n" for command in commands)
+    )
+
+
+def export_command(key, value):
+    """
+    Returns the ``export`` command for the variable ``key`` of the ``export_vars``
+    dictionary, with value ``value``.
+
+    - If the value is a dictionary itself (e.g. ``AWI_FESOM_YAML`` in fesom-1.4), the
+      contents of the dictionary are exported inside ``''``.
+    - If the variable was added as a list (``ExportVar`` key, see
+      ``EnvironmentInfos.env_list_to_dict``), the value is the whole assignment. The
+      legacy string-encoded keys (``[(list)]`` suffix) are also supported.
+    - If the variable contains a repetition index (``[(int)]``), it is removed.
+
+    Parameters
+    ----------
+    key : str or ExportVar
+        Name of the variable.
+    value : any
+        Value of the variable.
+
+    Returns
+    -------
+    str :
+        The export command.
+    """
+    if isinstance(key, ExportVar):
+        return f"export {value}"
+    if isinstance(value, dict):
+        return f"export {key}='{str(value)}'"
+    if key.endswith(LIST_SUFFIX):
+        return f"export {value}"
+    match = INDEX_PATTERN.search(key)
+    if match:
+        return f"export {key[:match.start()]}={str(value)}"
+    return f"export {key}={str(value)}"
+
+
+def resolve_variables(environment, complete_config):
+    """
+    Resolves the variables (``${...}``) of ``environment`` in place, looking them up
+    in ``complete_config``. The environment is not traversed if it contains no
+    variables.
+
+    TODO: change this to be done using the method ``complete_config.finalize()``,
+    currently not working due to a problem with the dates
+
+    Parameters
+    ----------
+    environment : dict
+        Environment to resolve (e.g. the ``environment_changes`` of a component).
+    complete_config : dict
+        Dictionary containing all the compiled information from the `yaml` files
+        needed for the current `ESM-Tools` operation, used to look up the variables.
+    """
+    import esm_parser
+
+    if contains_variables(environment):
+        esm_parser.recursive_run_function(
+            [],
+            environment,
+            "atomic",
+            esm_parser.find_variable,
+            complete_config,
+            {},
+            {},
+        )
+
+
+def contains_variables(tree):
+    """
+    Checks whether any key or value in ``tree`` contains a variable (``${``).
+    """
+    if isinstance(tree, str):
+        return "${" in tree
+    if isinstance(tree, dict):
+        return any(
+            contains_variables(key) or contains_variables(value)
+            for key, value in tree.items()
+        )
+    if isinstance(tree, list):
+        return any(contains_variables(value) for value in tree)
+    return False
+
+
+def has_general_environment(complete_config):
+    """
+    Checks whether ``complete_config`` belongs to a coupled setup with environment
+    changes defined in the ``general`` section. In that case, the environment changes
+    of the components are reloaded from the setup file (see
+    ``EnvironmentInfos.load_component_env_changes_only_in_setup``).
+
+    Parameters
+    ----------
+    complete_config : dict
+        Dictionary containing all the compiled information from the `yaml` files
+        needed for the current `ESM-Tools` operation.
+
+    Returns
+    -------
+    bool :
+        ``True`` if a general environment overwrites the component ones.
+    """
+    general = complete_config.get("general")
+    if not isinstance(general, dict):
+        return False
+    # Is it a coupled setup?
+    coupled_setup = general.get("coupled_setup", False)
+
+    # Check if a general setup environment exists that will overwrite the component
+    # setups
+    # TODO: do this if the model include other models and the environment is
+    # labelled as priority over the other models environment (OIFS case)
+    return bool(coupled_setup) and (
+        "compiletime_environment_changes" in general or
+        "runtime_environment_changes" in general or
+        "environment_changes" in general
+    )
+
+
+def environment_fingerprint(run_or_compile, complete_config, model=None):
+    """
+    Returns a stable fingerprint of the inputs that ``EnvironmentInfos`` uses to build
+    an environment: the ``computer`` section, the ``*environment_changes`` and
+    ``version`` of each chapter, ``run_or_compile`` and ``model``.
+
+    The fingerprint is order-sensitive, as the order of the module actions and
+    exports matters for the resulting environment. Returns ``None`` when the
+    environment cannot be safely memoized: when the components' environments are
+    reloaded from the setup file and resolved against the whole ``complete_config``
+    (see ``has_general_environment``), or when the inputs contain objects without a
+    stable representation.
+
+    Parameters
+    ----------
+    run_or_compile : str
+        ``compiletime`` or ``runtime``.
+    complete_config : dict
+        Dictionary containing all the compiled information from the `yaml` files
+        needed for the current `ESM-Tools` operation.
+    model : str
+        Model for which the environment is required.
+
+    Returns
+    -------
+    str or None :
+        Hexadecimal fingerprint.
+    """
+    complete_config = complete_config or {}
+    if has_general_environment(complete_config):
+        return None
+    return inputs_fingerprint(
+        (run_or_compile, model, environment_inputs(complete_config))
+    )
+
+
+def environment_inputs(complete_config):
+    """
+    Returns the parts of ``complete_config`` used as the environment inputs in
+    ``environment_fingerprint``: the ``computer`` section, and the
+    ``*environment_changes``, ``version`` and ``setup_name`` of each chapter.
+    """
+    inputs = {}
+    for chapter, chapter_config in complete_config.items():
+        if chapter == "computer":
+            inputs[chapter] = chapter_config
+        elif isinstance(chapter_config, dict):
+            inputs[chapter] = {
+                key: value
+                for key, value in chapter_config.items()
+                if key in ["version", "setup_name"] or is_environment_changes_key(key)
+            }
+        else:
+            inputs[chapter] = chapter_config
+    return inputs
+
+
+def inputs_fingerprint(inputs):
+    """
+    Returns the hash of ``inputs`` (see ``cache.tree_hash``), or ``None`` if they
+    contain objects without a stable representation.
+    """
+    # Each entry of the chapters is hashed separately, instead of building the
+    # ``repr`` of the whole configuration on every instantiation (see
+    # ``lock_fingerprint``)
+    return cache.tree_hash(inputs, depth=3)
+
+
+def lock_fingerprint(
+    run_or_compile, complete_config=None, model=None, machine_file=None
+):
+    """
+    Returns the fingerprint stored in the lockfiles (see ``EnvironmentInfos.to_lock``)
+    to detect stale locks. It covers the same inputs as ``environment_fingerprint``
+    and the content of the ``machine_file``, if any. Unlike
+    ``environment_fingerprint``, it is also computed for coupled setups with a
+    ``general`` environment, from the ``*environment_changes``, ``version`` and
+    ``setup_name`` of their chapters. Changes in other variables of the
+    configuration referenced by those environments are not detected.
+
+    Parameters
+    ----------
+    run_or_compile : str
+        ``compiletime`` or ``runtime``.
+    complete_config : dict
+        Dictionary containing all the compiled information from the `yaml` files
+        needed for the current `ESM-Tools` operation.
+    model : str
+        Model for which the environment is required.
+    machine_file : str
+        Machine file used instead of the ``computer`` section (given, or found from
+        the hostname).
+
+    Returns
+    -------
+    str or None :
+        Hexadecimal fingerprint.
+    """
+    complete_config = complete_config or {}
+    machine = None
+    if machine_file:
+        # The content identifies the machine file, regardless of its path and
+        # modification time
+        try:
+            machine = cache.file_signature(machine_file)[-1]
+        except OSError:
+            machine = machine_file
+    return inputs_fingerprint(
+        (run_or_compile, model, environment_inputs(complete_config), machine)
+    )
+
+
+def contains_choose(tree):
+    """
+    Checks whether ``tree`` contains any ``choose_`` key.
+    """
+    if isinstance(tree, dict):
+        return any(
+            (isinstance(key, str) and key.startswith("choose_"))
+            or contains_choose(value)
+            for key, value in tree.items()
+        )
+    if isinstance(tree, list):
+        return any(contains_choose(value) for value in tree)
+    return False
+
+
+def is_environment_changes_key(key):
+    """
+    Checks whether ``key`` is one of the ``environment_changes``,
+    ``compiletime_environment_changes`` or ``runtime_environment_changes`` keys.
+    """
+    return isinstance(key, str) and key.endswith("environment_changes")
+
 
 ######################################################################################
 ########################### class "environment_infos" ################################
@@ -47,36 +685,109 @@ class EnvironmentInfos:
     model : string
         Model for which the environment is required. If not defined, this method
         will loop through all the available keys in ``complete_config``.
+    deepcopy_config : bool
+        If ``True``, deep-copy the whole ``complete_config`` before using it, instead
+        of only projecting out the environment-relevant subtrees (see
+        ``project_environment_config``). Defaults to ``False``.
+    memoize : bool
+        If ``True``, reuse the ``config`` and ``commands`` of a previous instance
+        built in this process from identical environment inputs (see
+        ``environment_fingerprint`` and ``ENVIRONMENT_CACHE``). Defaults to
+        ``False``.
+    freeze_modules : bool
+        If ``True``, the ``module_actions`` are executed once while generating the
+        ``commands``, and replaced in the scripts by the ``export`` and ``unset``
+        commands that reproduce the resulting environment (see
+        ``esm_environment.frozen``). Defaults to ``False``.
+    module_command : str
+        ``modulecmd``-like command used to run the ``module_actions`` when
+        ``freeze_modules`` is ``True`` (see ``frozen.frozen_commands``).
+    timings : timing.PhaseTimings or callable
+        If given, the duration of each phase of the environment generation (per
+        component when applicable) is recorded in this ``PhaseTimings`` object, or
+        passed to this callable (see ``esm_environment.timing``). Defaults to
+        ``None`` (no instrumentation).
+    optimize : bool
+        If ``True``, remove the redundant module actions and shadowed exports from
+        the resolved ``config`` (see ``optimize``). The removed items are listed in
+        ``self.optimization_report``. Defaults to ``False``.
+    machine_file : str
+        Path to the machine file to use, instead of the ``computer`` section of
+        ``complete_config`` or the machine file determined from the hostname.
+    slim : bool
+        If ``True``, keep only the entries of ``config`` used to generate the scripts
+        once the environment is resolved (see ``slim``). Defaults to ``False``.
     """
 
-
-    def __init__(self, run_or_compile, complete_config=None, model=None):
-        # Ensure local copy of complete config to avoid mutating it... (facepalm)
-        complete_config = copy.deepcopy(complete_config)
-        # Load computer dictionary or initialize it from the correct machine file
-        if complete_config and "computer" in complete_config:
-            self.config = complete_config["computer"]
-        else:
-            self.machine_file = esm_parser.determine_computer_from_hostname()
-            self.config = esm_parser.yaml_file_to_dict(self.machine_file)
-            esm_parser.basic_choose_blocks(self.config, self.config)
-            esm_parser.recursive_run_function(
-                [],
-                self.config,
-                "atomic",
-                esm_parser.find_variable,
-                self.config,
-                [],
-                True,
+    # Resolve ``choose_`` blocks only in the keys merged by each
+    # ``apply_model_changes`` call, once ``config`` has been fully resolved
+    incremental_choose = True
+
+
+    def __init__(
+        self,
+        run_or_compile,
+        complete_config=None,
+        model=None,
+        deepcopy_config=False,
+        memoize=False,
+        freeze_modules=False,
+        module_command=None,
+        timings=None,
+        optimize=False,
+        machine_file=None,
+        slim=False,
+    ):
+        self.freeze_modules = freeze_modules
+        self.module_command = module_command
+        self.timings = timing.get_timings(timings)
+
+        # Reuse the results of an identical previous instance if possible
+        fingerprint = None
+        if memoize:
+            fingerprint = environment_fingerprint(
+                run_or_compile, complete_config, model
             )
+            if fingerprint:
+                # The machine file used is not part of ``complete_config``, and an
+                # edited machine file must not reuse the previous results
+                if not machine_file and "computer" not in (complete_config or {}):
+                    machine_file = machines.find_machine_file()
+                machine = None
+                if machine_file:
+                    try:
+                        machine = cache.file_signature(machine_file)
+                    except OSError:
+                        machine = machine_file
+                fingerprint = cache.hash_key(
+                    fingerprint, machine, freeze_modules, module_command, optimize
+                )
+            if fingerprint and self.load_memoized(fingerprint):
+                if slim:
+                    self.slim()
+                return
+
+        # Ensure local copy of complete config to avoid mutating it. Only the subtrees
+        # that are modified while building the environment are copied, the rest of
+        # the config is shared with the caller
+        inputs_config = complete_config
+        with self.phase("copy_config"):
+            if deepcopy_config:
+                complete_config = copy.deepcopy(complete_config) or {}
+            else:
+                complete_config = project_environment_config(complete_config)
+        # Load computer dictionary or initialize it from the correct machine file
+        with self.phase("load_computer"):
+            self.load_computer(complete_config, machine_file)
 
-        # Add_s can only be inside choose_ blocks in the machine file
-        for entry in ["add_module_actions", "add_export_vars", "add_unset_vars"]:
-            if entry in self.config:
-                del self.config[entry]
+        # Fingerprint of the inputs, written to the lockfiles (see ``to_lock``)
+        self.fingerprint = lock_fingerprint(
+            run_or_compile, inputs_config, model, getattr(self, "machine_file", None)
+        )
 
         # Load the general environments if any
-        self.general_environment(complete_config, run_or_compile)
+        with self.phase("general_environment"):
+            self.general_environment(complete_config, run_or_compile)
 
         # If the model is defined during the instantiation of the class (e.g.
         # during esm_master with a coupled setup), get the environment for that
@@ -87,10 +798,303 @@ class EnvironmentInfos:
             for model in complete_config:
                 self.apply_config_changes(run_or_compile, complete_config, model)
 
-        # Add the ENVIRONMENT_SET_BY_ESMTOOLS into the exports
+        # Add the ENVIRONMENT_SET_BY_ESMTOOLS into the exports. The environment
+        # commands for the script (``self.commands``) are generated on first access
         self.add_esm_var()
-        # Define the environment commands for the script
-        self.commands = self.get_shell_commands()
+
+        # Remove the redundant module actions and exports
+        if optimize:
+            with self.phase("optimize"):
+                self.optimize()
+
+        if fingerprint:
+            self.memoize(fingerprint)
+
+        # Drop the machine configuration not needed for the scripts
+        if slim:
+            self.slim()
+
+
+    def optimize(self):
+        """
+        Removes the module actions and exports of ``self.config`` that have no effect
+        in the scripts: repeated ``load`` actions, and exports shadowed by a later
+        export or unset of the same variable. ``purge``,
+        ``source`` lines and exports that reference earlier values are respected
+        (see ``esm_environment.optimize``).
+
+        Returns
+        -------
+        report : list
+            Removed items, also stored in ``self.optimization_report``.
+        """
+        from . import optimize
+
+        self.optimization_report = optimize.optimize_environment(self.config)
+        self.reset_commands()
+        return self.optimization_report
+
+
+    def slim(self):
+        """
+        Replaces ``self.config`` by a ``ResolvedEnvironment`` with only the
+        ``module_actions``, ``export_vars``, ``unset_vars`` and ``sh_interpreter``,
+        releasing the rest of the machine configuration. The ``commands`` are kept.
+        Later changes to other entries of ``config`` raise a ``KeyError``.
+        """
+        commands = self.commands
+        self.config = ResolvedEnvironment(self.config)
+        self.commands = commands
+
+
+    def phase(self, name, component=None):
+        """
+        Returns a context manager recording the duration of the phase ``name`` (for
+        ``component``) in ``self.timings``. Does nothing if the instrumentation is
+        disabled.
+        """
+        return getattr(self, "timings", timing.NULL_TIMINGS).phase(name, component)
+
+
+    @classmethod
+    def for_models(cls, run_or_compile, complete_config, models=None, timings=None):
+        """
+        Builds the environments of several ``models`` of a coupled setup in one pass.
+        The results are identical to instancing ``EnvironmentInfos(run_or_compile,
+        complete_config, model)`` for each model, but the machine configuration and
+        the ``general`` environment (including the reloading of the setup file in
+        ``load_component_env_changes_only_in_setup``) are resolved only once, and
+        each model's environment is derived from that shared base, copying only the
+        entries that its environment changes can modify.
+
+        Parameters
+        ----------
+        run_or_compile : str
+            A string indicating whether ``EnvironmentInfos`` was instanced from a
+            compilation operation (``compiletime``) or a run (``runtime``).
+        complete_config : dict
+            Dictionary containing all the compiled information from the `yaml` files
+            needed for the current `ESM-Tools` operation.
+        models : list
+            Models for which the environment is required. Defaults to
+            ``general.models`` or, if not defined, to all the chapters of
+            ``complete_config``.
+        timings : timing.PhaseTimings or callable
+            Records the duration of each phase (see ``EnvironmentInfos``).
+
+        Returns
+        -------
+        environments : dict
+            ``EnvironmentInfos`` instance of each model.
+        """
+        timings = timing.get_timings(timings)
+        inputs_config = complete_config
+        complete_config = project_environment_config(complete_config)
+        if models is None:
+            models = complete_config.get("general", {}).get("models") or list(
+                complete_config
+            )
+
+        # Resolve the shared base
+        base = cls.__new__(cls)
+        base.timings = timings
+        with base.phase("load_computer"):
+            base.load_computer(complete_config)
+        with base.phase("general_environment"):
+            base.general_environment(complete_config, run_or_compile)
+
+        # Entries of the base ``config`` that ``apply_model_changes`` may modify in
+        # place: the environment entries, and the entries with ``choose_`` blocks
+        # left to resolve
+        base_mutable = {"module_actions", "export_vars", "unset_vars"}
+        base_mutable.update(
+            key for key, value in base.config.items() if contains_choose(value)
+        )
+
+        environments = {}
+        for model in models:
+            environment = cls.__new__(cls)
+            environment.__dict__.update(base.__dict__)
+            # Copy only the entries that the changes of this model can modify (also
+            # the targets of its ``add_`` entries and the keys its ``choose_``
+            # blocks select on), and share the rest of the machine configuration
+            mutable = set(base_mutable)
+            model_chapter = complete_config[model]
+            if not isinstance(model_chapter, dict):
+                model_chapter = {}
+            for key, value in model_chapter.items():
+                if is_environment_changes_key(key):
+                    mutable.update(cls.choose_dependencies(value))
+            environment.config = {
+                key: copy.deepcopy(value) if key in mutable else value
+                for key, value in base.config.items()
+            }
+            environment.timings = timings
+            environment.fingerprint = lock_fingerprint(
+                run_or_compile,
+                inputs_config,
+                model,
+                getattr(base, "machine_file", None),
+            )
+            # ``apply_model_changes`` modifies the model chapter, so each model
+            # needs its own copy of the environment changes
+            model_config = {model: project_chapter(complete_config[model])}
+            environment.apply_config_changes(run_or_compile, model_config, model)
+            environment.add_esm_var()
+            environments[model] = environment
+
+        return environments
+
+
+    @classmethod
+    def ensemble(cls, run_or_compile, members, model=None, timings=None):
+        """
+        Builds the environments of the ``members`` of an ensemble, whose
+        configurations differ only in a few keys.
+
+        Members whose environment inputs are identical (see
+        ``environment_fingerprint``) are built once. The ``config`` and ``commands``
+        of the rest of members are derived from the ones of the first member (see
+        ``share_structure``): the unchanged subtrees and strings are shared, so the
+        memory used grows with the differences between members instead of with the
+        number of members. The ``config`` and ``commands`` of the members are
+        therefore read-only: deep-copy them before modifying them in place.
+
+        Parameters
+        ----------
+        run_or_compile : str
+            A string indicating whether ``EnvironmentInfos`` was instanced from a
+            compilation operation (``compiletime``) or a run (``runtime``).
+        members : dict
+            ``complete_config`` of each member.
+        model : str
+            Model for which the environment is required (see ``EnvironmentInfos``).
+        timings : timing.PhaseTimings or callable
+            Records the duration of each phase (see ``EnvironmentInfos``).
+
+        Returns
+        -------
+        environments : dict
+            ``EnvironmentInfos`` instance of each member.
+        """
+        environments = {}
+        built = {}
+        base = None
+        for member, complete_config in members.items():
+            fingerprint = environment_fingerprint(
+                run_or_compile, complete_config, model
+            )
+            if fingerprint in built:
+                environment = cls.__new__(cls)
+                environment.__dict__.update(built[fingerprint].__dict__)
+                environments[member] = environment
+                continue
+
+            environment = cls(run_or_compile, complete_config, model, timings=timings)
+            if base:
+                config = share_structure(base.config, environment.config)
+                commands = share_structure(base.commands, environment.commands)
+            else:
+                config = share_structure(None, environment.config)
+                commands = share_structure(None, environment.commands)
+            environment.config = config
+            environment.commands = commands
+
+            base = base or environment
+            if fingerprint:
+                built[fingerprint] = environment
+            environments[member] = environment
+
+        return environments
+
+
+    @classmethod
+    def get_commands_for_models(cls, run_or_compile, complete_config, models=None):
+        """
+        Returns the environment commands for each of the ``models`` of a coupled
+        setup. See ``for_models``.
+
+        Returns
+        -------
+        commands : dict
+            List of environment commands of each model.
+        """
+        environments = cls.for_models(run_or_compile, complete_config, models)
+        return {model: env.commands for model, env in environments.items()}
+
+
+    def load_computer(self, complete_config, machine_file=None):
+        """
+        Loads the ``computer`` section of ``complete_config`` into ``self.config`` or,
+        if it does not exist, loads the machine file of this host.
+
+        Parameters
+        ----------
+        complete_config : dict
+            Dictionary containing all the compiled information from the `yaml` files
+            needed for the current `ESM-Tools` operation.
+        machine_file : str
+            Machine file to load instead of the ``computer`` section or the machine
+            file of this host.
+        """
+        if machine_file:
+            self.machine_file = machine_file
+            self.config = machines.load_machine_config(self.machine_file)
+        elif complete_config and "computer" in complete_config:
+            self.config = complete_config["computer"]
+        else:
+            self.machine_file = machines.find_machine_file()
+            self.config = machines.load_machine_config(self.machine_file)
+
+        # Add_s can only be inside choose_ blocks in the machine file
+        for entry in ["add_module_actions", "add_export_vars", "add_unset_vars"]:
+            if entry in self.config:
+                del self.config[entry]
+        self.reset_commands()
+
+
+    def load_memoized(self, fingerprint):
+        """
+        Loads the ``config``, ``commands``, ``machine_file``, ``fingerprint`` and
+        ``optimization_report`` stored in ``ENVIRONMENT_CACHE`` for the given
+        ``fingerprint``.
+
+        Parameters
+        ----------
+        fingerprint : str
+            Fingerprint of the environment inputs (see ``environment_fingerprint``).
+
+        Returns
+        -------
+        bool :
+            ``True`` if the environment was found in the cache.
+        """
+        cached = ENVIRONMENT_CACHE.get(fingerprint)
+        if cached is None:
+            return False
+        # Copy, so that changes in this instance do not leak into the cache
+        attributes = copy.deepcopy(cached)
+        for attribute, value in attributes.items():
+            setattr(self, attribute, value)
+        return True
+
+
+    def memoize(self, fingerprint):
+        """
+        Stores the ``config``, ``commands``, ``machine_file``, ``fingerprint`` and
+        ``optimization_report`` of this instance in ``ENVIRONMENT_CACHE`` under the
+        given ``fingerprint``.
+
+        Parameters
+        ----------
+        fingerprint : str
+            Fingerprint of the environment inputs (see ``environment_fingerprint``).
+        """
+        attributes = {"config": self.config, "commands": self.commands}
+        for attribute in ["machine_file", "fingerprint", "optimization_report"]:
+            if hasattr(self, attribute):
+                attributes[attribute] = getattr(self, attribute)
+        ENVIRONMENT_CACHE.put(fingerprint, copy.deepcopy(attributes))
 
 
     def add_esm_var(self):
@@ -103,6 +1107,7 @@ class EnvironmentInfos:
             self.config["export_vars"]["ENVIRONMENT_SET_BY_ESMTOOLS"] = "TRUE"
         else:
             self.config["export_vars"] = {"ENVIRONMENT_SET_BY_ESMTOOLS": "TRUE"}
+        self.reset_commands()
 
 
     def apply_config_changes(self, run_or_compile, config, model):
@@ -111,9 +1116,10 @@ class EnvironmentInfos:
         ``model``.
         """
 
-        self.apply_model_changes(
-            model, run_or_compile=run_or_compile, modelconfig=config[model]
-            )
+        with self.phase("apply_model_changes", model):
+            self.apply_model_changes(
+                model, run_or_compile=run_or_compile, modelconfig=config[model]
+                )
 
 
     def apply_model_changes(self, model, run_or_compile="runtime", modelconfig=None):
@@ -133,8 +1139,11 @@ class EnvironmentInfos:
         modelconfig : dict
             Information compiled from the `yaml` files for this specific component.
         """
+        import esm_parser
 
         if not modelconfig:
+            from esm_rcfile import FUNCTION_PATH
+
             print("Should not happen anymore...")
             modelconfig = esm_parser.yaml_file_to_dict(
                 FUNCTION_PATH + "/" + model + "/" + model
@@ -177,23 +1186,107 @@ class EnvironmentInfos:
                     # dictionary (machine-file export_vars are from now on always a
                     # dictionary but add_export_vars of components and setups are
                     # allowed to be lists for retro-compatibility)
-                    self.turn_add_export_vars_to_dict(modelconfig, entry)
+                    self.turn_add_export_vars_to_dict(modelconfig, entry, model)
 
             # Merge the ``environment_changes`` into the general ``config``
             self.config.update(modelconfig["environment_changes"])
-            # Change any ``choose_computer.*`` block in ``config`` to ``choose_*``
-            self.remove_computer_from_choose(self.config)
 
-            # Resolve ``choose_`` blocks
-            esm_parser.basic_choose_blocks(self.config, self.config)
+            # Resolve ``choose_`` blocks. The first time, the whole ``config`` is
+            # resolved. Afterwards, only the keys merged from the
+            # ``environment_changes`` can contain unresolved ``choose_`` blocks
+            with self.phase("choose_resolution", model):
+                if self.incremental_choose and getattr(self, "_choose_resolved", False):
+                    self.resolve_choose_blocks_in(modelconfig["environment_changes"])
+                else:
+                    # Change any ``choose_computer.*`` block in ``config`` to
+                    # ``choose_*``
+                    self.remove_computer_from_choose(self.config)
+                    esm_parser.basic_choose_blocks(self.config, self.config)
+                    self._choose_resolved = True
 
             # Remove the environment variables from the config
             for entry in ["add_module_actions", "add_export_vars", "add_unset_vars"]:
                 if entry in self.config:
                     del self.config[entry]
+            self.reset_commands()
 
 
-    def turn_add_export_vars_to_dict(self, modelconfig, entry):
+    def resolve_choose_blocks_in(self, changes):
+        """
+        Resolves the ``choose_`` blocks introduced in ``self.config`` by merging the
+        ``changes`` (normally the ``environment_changes`` of a component), assuming
+        that the rest of ``self.config`` is already resolved.
+
+        Instead of resolving the whole ``self.config``, only a scope is resolved,
+        containing the keys of ``changes``, the keys the ``choose_`` blocks select
+        on, and the keys that are targeted by ``add_`` entries. The result is then
+        merged back into ``self.config``.
+
+        Parameters
+        ----------
+        changes : dict
+            Changes merged into ``self.config``.
+        """
+        import esm_parser
+
+        # Find the keys that the resolution depends on
+        scope_keys = set(changes)
+        scope_keys.update(
+            ["module_actions", "export_vars", "unset_vars"] +
+            ["add_module_actions", "add_export_vars", "add_unset_vars"]
+        )
+        scope_keys.update(self.choose_dependencies(changes))
+
+        # Resolve the scope, preserving the order of the keys in ``self.config``
+        scope = {
+            key: value for key, value in self.config.items() if key in scope_keys
+        }
+        self.remove_computer_from_choose(scope)
+        esm_parser.basic_choose_blocks(scope, scope)
+
+        # Merge the resolved scope back
+        for key in [key for key in self.config if key in scope_keys]:
+            if key not in scope:
+                del self.config[key]
+        self.config.update(scope)
+
+
+    @staticmethod
+    def choose_dependencies(tree):
+        """
+        Returns the top-level keys that the ``choose_`` blocks and ``add_`` entries in
+        ``tree`` depend on: the keys they select on (e.g. ``name`` for
+        ``choose_computer.name``) and the keys they add entries to (e.g.
+        ``module_actions`` for ``add_module_actions``).
+
+        Parameters
+        ----------
+        tree : dict or list
+            Structure to search in.
+
+        Returns
+        -------
+        dependencies : set
+            Top-level keys the structure depends on.
+        """
+        dependencies = set()
+        if isinstance(tree, dict):
+            for key, value in tree.items():
+                if isinstance(key, str):
+                    if key.startswith("choose_"):
+                        selector = key[len("choose_"):].replace("computer.", "")
+                        dependencies.add(selector)
+                        dependencies.add(selector.split(".")[0])
+                    elif key.startswith("add_"):
+                        dependencies.add(key[len("add_"):])
+                dependencies.update(EnvironmentInfos.choose_dependencies(value))
+        elif isinstance(tree, list):
+            for value in tree:
+                dependencies.update(EnvironmentInfos.choose_dependencies(value))
+        return dependencies
+
+
+    def turn_add_export_vars_to_dict(self, modelconfig, entry, component=None):
         """
         Turns the given ``entry`` in ``modelconfig`` (normally ``add_export_vars``) into
         a dictionary, if it is not a dictionary yet. This function is necessary for
@@ -207,40 +1300,38 @@ class EnvironmentInfos:
         entry : str
             The environment variable (originally developed for ``add_export_vars``) to
             be turned into a dictionary.
+        component : str
+            Name of the component the variables come from.
         """
+        self.lists_to_dicts(modelconfig["environment_changes"], entry, component)
 
-        # Find the variables whose names contains the entry (e.g. add_export_vars)
-        path_sep = ","
-        entry_paths = esm_parser.find_key(
-            modelconfig["environment_changes"],
-            entry,
-            paths2finds = [],
-            sep = path_sep,
-        )
-        # Loop through the variables
-        for entry_path in entry_paths:
-            # Split the path and define the export_dict dictionary that links to the
-            # current entry. Later, if the content of export_dict is a list it will be
-            # turned into a dictionary itself
-            path_to_var = entry_path.split(path_sep)
-            path_to_var = [esm_parser.convert(leaf) for leaf in path_to_var]
-            if len(path_to_var) > 1:
-                export_dict = esm_parser.find_value_for_nested_key(
-                    modelconfig["environment_changes"],
-                    path_to_var[-2],
-                    path_to_var[:-2],
-                )
-            else:
-                export_dict = modelconfig["environment_changes"]
-            # Get the value of export_dict
-            export_vars = export_dict[path_to_var[-1]]
 
-            # If export_vars is a list transform it into a dictionary
-            if isinstance(export_vars, list):
-                self.env_list_to_dict(export_dict, path_to_var[-1])
+    def lists_to_dicts(self, chapter, entry, component=None):
+        """
+        Recursively transforms, in place, the lists of ``chapter`` whose keys contain
+        ``entry`` (e.g. ``add_export_vars``) into dictionaries (see
+        ``env_list_to_dict``), in a single traversal of ``chapter``.
 
+        Parameters
+        ----------
+        chapter : dict
+            Dictionary to search in.
+        entry : str
+            Substring of the keys to transform.
+        component : str
+            Name of the component the variables come from.
+        """
+        for key, value in chapter.items():
+            # If the key contains the entry and its value is a list, transform it into
+            # a dictionary (only the value changes, so it is safe while iterating)
+            if isinstance(value, list):
+                if isinstance(key, str) and entry in key:
+                    self.env_list_to_dict(chapter, key, component)
+            elif isinstance(value, dict):
+                self.lists_to_dicts(value, entry, component)
 
-    def env_list_to_dict(self, export_dict, key):
+
+    def env_list_to_dict(self, export_dict, key, component=None):
         """
         Transforms lists in ``export_dict`` in dictionaries. This allows to add lists of
         ``export_vars`` to the machine-defined ``export_vars`` that should always be a
@@ -260,16 +1351,17 @@ class EnvironmentInfos:
                        - 'SOMETHING=dummy'
 
         The ``export_dict[key]`` (where ``key = add_export_vars``) will be transformed
-        in this function from being a list to be the following dictionary:
+        in this function from being a list to be a dictionary whose keys are
+        ``ExportVar`` records (indexed per repeated element, so repetitions are
+        preserved) and whose values are the elements of the list:
 
-        .. code-block::yaml
-           'SOMETHING=dummy[(0)][(list)]': 'SOMETHING=dummy'
-           'somethingelse=dummy[(0)][(list)]': 'somethingelse=dummy'
-           'SOMETHING=dummy[(1)][(list)]': "SOMETHING=dummy'
+        .. code-block::python
+           ExportVar("SOMETHING", "dummy", "your_model", 0): 'SOMETHING=dummy'
+           ExportVar("somethingelse", "dummy", "your_model", 0): 'somethingelse=dummy'
+           ExportVar("SOMETHING", "dummy", "your_model", 1): 'SOMETHING=dummy'
 
-        Note that, once all the environments are resolved, and before writing the
-        exports in the bash files, the ``export_vars`` dictionary is transformed again
-        into a list and the indexes and ``[(list)]`` strings are removed.
+        Once all the environments are resolved, the values of the ``ExportVar`` keys
+        are written as they are in the export commands (see ``export_command``).
 
         Parameters
         ----------
@@ -278,6 +1370,8 @@ class EnvironmentInfos:
             into a dictionary.
         key : str
             The key to the value.
+        component : str
+            Name of the component the variables come from, stored in the records.
         """
         # Load the value
         export_vars = export_dict[key]
@@ -289,21 +1383,14 @@ class EnvironmentInfos:
             )
             sys.exit(1)
 
-        # Loop through the elements of the list
+        # Loop through the elements of the list, counting the occurrences of each
+        # element to define its index
         new_export_vars = {}
+        occurrences = {}
         for var in export_vars:
-            # Initialize index
-            index = 0
-            while True:
-                # If the key with the current index already exists move the move the
-                # index forward
-                if var + f"[({index})][(list)]" in new_export_vars:
-                    index += 1
-                # If the key with the current index does not exist yet, add the element
-                # to the dictionary
-                else:
-                    new_export_vars[f"{var}[({index})][(list)]"] = var
-                    break
+            index = occurrences.get(var, 0)
+            occurrences[var] = index + 1
+            new_export_vars[ExportVar.from_assignment(var, component, index)] = var
 
         # Redefined the transformed dictionary
         export_dict[key] = new_export_vars
@@ -325,21 +1412,9 @@ class EnvironmentInfos:
         """
 
         # If the general section exists load the general environments
-        general_env = False
-        if "general" in complete_config:
-            # Is it a coupled setup?
-            coupled_setup = complete_config["general"].get("coupled_setup", False)
-
-            # Check if a general setup environment exists that will overwrite the
-            # component setups
-            if coupled_setup and (
-                "compiletime_environment_changes" in complete_config["general"] or
-                "runtime_environment_changes" in complete_config["general"] or
-                "environment_changes" in complete_config["general"]
-            ):  # TODO: do this if the model include other models and the environment is
-                # labelled as priority over the other models environment (OIFS case)
-                general_env = True
-                self.apply_config_changes(run_or_compile, complete_config, "general")
+        general_env = has_general_environment(complete_config)
+        if general_env:
+            self.apply_config_changes(run_or_compile, complete_config, "general")
 
         # If there is a general environment remove all the model specific environments
         # defined in the model files and preserve only the model specific environments
@@ -374,35 +1449,10 @@ class EnvironmentInfos:
             )
             sys.exit(1)
 
-        # Find the setup file
-        include_path, needs_load = esm_parser.look_for_file(
-            setup,
-            setup + "-" + version,
-        )
-        # If setup file not found throw and error TODO: logging
-        if not include_path:
-            print(f"File for {setup}-{version} not found")
-            sys.exit(1)
-        # Load the file TODO: logging
-        if needs_load:
-            setup_config = esm_parser.yaml_file_to_dict(include_path)
-        else:
-            print(f"A setup needs to load a file so this line shouldn't be reached")
-            sys.exit(1)
-
-        # Add the attachment files (e.g. the environment variables can be in a
-        # further_reading file)
-        for attachment in esm_parser.CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE:
-            # Add the attachment file chapters (e.g. there is a further_reading chapter
-            # at the same level of general and the components)
-            esm_parser.attach_to_config_and_remove(setup_config, attachment)
-            # Add the attachment files in each chapter (i.e. in general, components,
-            # etc.)
-            for component in list(setup_config):
-                esm_parser.attach_to_config_and_remove(
-                    setup_config[component],
-                    attachment,
-                )
+        # Load the setup file and its attachments (cached per process). The
+        # returned dictionary is shared, so it must not be modified
+        with self.phase("load_setup_config"):
+            setup_config = setups.load_setup_config(setup, version)
 
         # Define the possible environment variables
         environment_vars = [
@@ -427,21 +1477,14 @@ class EnvironmentInfos:
                     del model_config[env_var]
                 # 2. Redefine the variable
                 if env_var in setup_config.get(model, {}):
+                    # Copy the environment, as ``setup_config`` is shared through the
+                    # setup cache
+                    setup_config_env = copy.deepcopy(setup_config[model][env_var])
                     # Solve any unresolved variables in the reloaded setup environment
-                    # TODO: change this to  be out of the loop using the method
-                    # ``model_config.finalize()``, currently not working due to
-                    # a problem with the dates
-                    esm_parser.recursive_run_function(
-                        [],
-                        setup_config[model][env_var],
-                        "atomic",
-                        esm_parser.find_variable,
-                        complete_config,
-                        {},
-                        {},
-                    )
+                    with self.phase("resolve_variables", model):
+                        resolve_variables(setup_config_env, complete_config)
                     # Actually redefine the variable
-                    model_config[env_var] = setup_config[model][env_var]
+                    model_config[env_var] = setup_config_env
 
 
     def replace_model_dir(self, model_dir):
@@ -454,13 +1497,135 @@ class EnvironmentInfos:
         model_dir : str
             The replacement string for ${model_dir}
         """
-        for entry in ["export_vars"]:
+        self.substitute_placeholders({"model_dir": model_dir})
+
+
+    def substitute_placeholders(self, placeholders, entries=("export_vars",)):
+        """
+        Replaces the ``${name}`` placeholders in the keys and values of the
+        ``entries`` of ``config`` in one pass, keeping their structure (see
+        ``PlaceholderTemplate``).
+
+        Parameters
+        ----------
+        placeholders : dict or PlaceholderTemplate
+            Replacement of each placeholder name (e.g. ``{"model_dir": ...,
+            "work_dir": ...}``), or a template built from them to reuse it for
+            several environments.
+        entries : tuple
+            Entries of ``config`` where the placeholders are replaced. Defaults to
+            ``export_vars``.
+        """
+        if not isinstance(placeholders, PlaceholderTemplate):
+            placeholders = PlaceholderTemplate(placeholders)
+        for entry in entries:
             if entry in self.config:
-                newlist = []
-                for line in self.config[entry]:
-                    newline = line.replace("${model_dir}", model_dir)
-                    newlist.append(newline)
-                self.config[entry] = newlist
+                self.config[entry] = placeholders.substitute_tree(self.config[entry])
+        self.reset_commands()
+
+
+    @property
+    def commands(self):
+        """
+        List of the environment operations, to be used in the compilation and run
+        scripts (see ``get_shell_commands``).
+
+        The list is generated from ``config`` on first access and kept as a snapshot.
+        The methods of this class that modify ``config`` (e.g.
+        ``replace_model_dir``, ``substitute_placeholders`` or ``optimize``) discard
+        it, but changes made directly to ``config`` are not detected: call
+        ``reset_commands`` after them.
+        """
+        if getattr(self, "_commands", None) is None:
+            with self.phase("get_shell_commands"):
+                self._commands = self.get_shell_commands()
+        return self._commands
+
+
+    @commands.setter
+    def commands(self, commands):
+        self._commands = commands
+
+
+    def reset_commands(self):
+        """
+        Discards the ``commands`` snapshot, so that they are generated again from
+        ``config`` on the next access.
+        """
+        self._commands = None
+
+
+    def delta(self, loaded, unset_leaked=False):
+        """
+        Returns the differences between the environment ``loaded`` in a shell and
+        this one, and the commands that turn the former into the latter (see
+        ``esm_environment.delta``).
+
+        Parameters
+        ----------
+        loaded : EnvironmentInfos
+            Environment already loaded in the shell (e.g. the ``compiletime`` one).
+        unset_leaked : bool
+            If ``True``, unset the variables exported by ``loaded`` that this
+            environment does not export. Defaults to ``False`` (they are only
+            reported).
+
+        Returns
+        -------
+        delta : dict
+            See ``delta.environment_delta``.
+        """
+        from . import delta
+
+        return delta.environment_delta(loaded, self, unset_leaked)
+
+
+    def delta_commands(self, loaded, unset_leaked=False):
+        """
+        Returns only the commands needed to go from the environment ``loaded`` in a
+        shell to this one (see ``delta``).
+
+        Returns
+        -------
+        list :
+            Environment operations, laid out as ``commands``.
+        """
+        return self.delta(loaded, unset_leaked)["commands"]
+
+
+    def exports(self):
+        """
+        Returns the ``export_vars`` as an ordered list of ``ExportVar`` records. The
+        variables added as lists are returned with their value as currently found in
+        ``export_vars``, and the ones defined as dictionary entries are returned as
+        records with ``from_list = False``.
+
+        Returns
+        -------
+        list :
+            ``ExportVar`` record of each exported variable.
+        """
+        export_vars = self.config.get("export_vars", {})
+        records = []
+        for key, value in export_vars.items():
+            if isinstance(key, ExportVar):
+                record = ExportVar.from_assignment(value, key.component, key.index)
+            elif str(key).endswith(LIST_SUFFIX):
+                index = INDEX_PATTERN.search(str(key)[:-len(LIST_SUFFIX)])
+                record = ExportVar.from_assignment(
+                    value, index=int(index.group().strip("[()]")) if index else 0
+                )
+            else:
+                name = str(key)
+                match = INDEX_PATTERN.search(name)
+                record = ExportVar(
+                    name[:match.start()] if match else name,
+                    value,
+                    index=int(match.group().strip("[()]")) if match else 0,
+                    from_list=False,
+                )
+            records.append(record)
+        return records
 
 
     def get_shell_commands(self):
@@ -478,63 +1643,90 @@ class EnvironmentInfos:
             A list of the environment operations, to be used in the compilation and run
             scripts.
         """
+        return list(self.iter_shell_commands())
+
+
+    def iter_shell_commands(self):
+        """
+        Generator version of ``get_shell_commands``, that yields the commands one by
+        one.
 
-        environment = []
+        Yields
+        ------
+        str :
+            Environment operation.
+        """
+        config = self.config
         # Write module actions
-        if "module_actions" in self.config:
-            for action in self.config["module_actions"]:
-                # seb-wahl: workaround to allow source ... to be added to the batch header
-                # until a proper solution is available. Required with FOCI
-                if action.startswith("source"):
-                    environment.append(action)
-                else:
-                    environment.append(f"module {action}")
+        yield from self.module_commands()
         # Add an empty string as a newline:
-        environment.append("")
-        if "export_vars" in self.config:
-            for var in self.config["export_vars"]:
-                # If export_vars is a dictionary
-                if isinstance(self.config["export_vars"], dict):
-                    # If the variable is a dictionary itself (e.g. "AWI_FESOM_YAML"
-                    # in fesom-1.4) add the contents of the dictionary as the value of
-                    # the exported variable inside '""'
-                    if isinstance(self.config["export_vars"][var], dict):
-                        key = var
-                        value = self.config["export_vars"][key]
-                        environment.append(f"export {key}='{str(value)}'")
-                    # If the value of the variable is not a dictionary
-                    else:
-                        key = var
-                        value = self.config["export_vars"][key]
-                        # Define the pattern for indexes [(int)]
-                        ipattern = "\[+\(\d+\)+\]$"
-                        # If the variable was added as a list produce the correct string
-                        if key.endswith("[(list)]"):
-                            key = key.replace("[(list)]", "")
-                            environment.append(f"export {value}")
-                        # If the variable contained a repetition index, remove it
-                        elif re.search(ipattern, key):
-                            environment.append(
-                                f"export {re.sub(ipattern, '', key)}={str(value)}"
-                            )
-                        # It it is a normal variable return the export command
-                        else:
-                            environment.append(f"export {key}={str(value)}")
-                # If export_vars is a list append the export command (this should not
-                # happen anymore as the export_vars in the machine files should be all
-                # defined now as dictionaries
-                else:
-                    environment.append("export {str(var)}")
-        environment.append("")
+        yield ""
+        if "export_vars" in config:
+            export_vars = config["export_vars"]
+            # If export_vars is a dictionary
+            if isinstance(export_vars, dict):
+                for key, value in export_vars.items():
+                    yield export_command(key, value)
+            # If export_vars is a list append the export command (this should not
+            # happen anymore as the export_vars in the machine files should be all
+            # defined now as dictionaries
+            else:
+                for var in export_vars:
+                    yield f"export {str(var)}"
+        yield ""
         # Write the unset commands
-        if "unset_vars" in self.config:
-            for var in self.config["unset_vars"]:
-                environment.append(f"unset {var}")
+        if "unset_vars" in config:
+            for var in config["unset_vars"]:
+                yield f"unset {var}"
 
-        return environment
 
+    def module_commands(self):
+        """
+        Returns the commands of the ``module_actions``, or the commands reproducing
+        their resulting environment if ``freeze_modules`` is ``True`` (see
+        ``frozen_module_commands``).
+
+        Returns
+        -------
+        list :
+            Module commands.
+        """
+        # Write the environment resulting from the module actions
+        if getattr(self, "freeze_modules", False):
+            return self.frozen_module_commands()
+        commands = []
+        for action in self.config.get("module_actions", []):
+            # seb-wahl: workaround to allow source ... to be added to the batch header
+            # until a proper solution is available. Required with FOCI
+            if action.startswith("source"):
+                commands.append(action)
+            else:
+                commands.append(f"module {action}")
+        return commands
 
-    def write_dummy_script(self, include_set_e=True):
+
+    def frozen_module_commands(self):
+        """
+        Returns the ``export`` and ``unset`` commands that reproduce the environment
+        resulting from running the ``module_actions`` (see
+        ``frozen.frozen_commands``). The result is cached on disk until the
+        ``module_actions`` change.
+
+        Returns
+        -------
+        list :
+            ``export`` and ``unset`` commands.
+        """
+        return frozen.frozen_commands(
+            self.config.get("module_actions", []),
+            self.config.get("sh_interpreter", "/bin/bash"),
+            getattr(self, "module_command", None),
+        )
+
+
+    def write_dummy_script(
+        self, include_set_e=True, shared_environment=False, environment_directory=None
+    ):
         """
         Writes a dummy script containing only the header information, module
         commands, and export variables. The actual compile/configure commands
@@ -546,23 +1738,283 @@ class EnvironmentInfos:
             Default to True, whether or not to include a ``set -e`` at the
             beginning of the script. This causes the shell to stop as soon as
             an error is encountered.
+        shared_environment : bool
+            If ``True``, the environment is written to a shared file that the
+            header sources, instead of inlining it (see ``write_environment_file``).
+            Defaults to ``False``.
+        environment_directory : str
+            Directory of the shared environment file. Defaults to the current
+            working directory.
+        """
+        environment_file = None
+        if shared_environment:
+            environment_file = self.write_environment_file(environment_directory or ".")
+        cache.atomic_write(
+            "dummy_script.sh", self.script_header(include_set_e, environment_file)
+        )
+
+
+    def environment_file_name(self):
+        """
+        Returns the name of the shared environment file of this environment,
+        ``esm_environment_<hash>.sh``, where ``<hash>`` is computed from the
+        ``sh_interpreter`` and the ``commands``.
+        """
+        content_hash = cache.hash_key(
+            self.config.get("sh_interpreter", "/bin/bash"), self.commands
+        )
+        return f"esm_environment_{content_hash[:16]}.sh"
+
+
+    def write_environment_file(self, directory="."):
+        """
+        Writes the ``commands`` into a content-addressed file in ``directory`` (see
+        ``environment_file_name``), to be sourced by the scripts instead of
+        inlining the environment in each of them. The file is written only if it
+        does not exist yet, so it is shared by all the scripts and runs with the
+        same environment.
+
+        Parameters
+        ----------
+        directory : str
+            Directory where the file is written. It is created if needed. Defaults
+            to the current working directory.
+
+        Returns
+        -------
+        str :
+            Absolute path of the environment file.
+        """
+        path = os.path.abspath(os.path.join(directory, self.environment_file_name()))
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            header = (
+                f'# Environment generated by esm-tools for '
+                f'{self.config.get("sh_interpreter", "/bin/bash")}\n'
+            )
+            write_script(path, header, self.commands)
+        return path
+
+
+    def script_header(self, include_set_e=True, environment_file=None):
+        """
+        Returns the header of the scripts (the contents of the ``dummy_script.sh``):
+        the shebang, the module commands and the export variables. The header is
+        rendered once and kept in memory until the ``commands`` change.
+
+        Parameters
+        ----------
+        include_set_e : bool
+            Default to True, whether or not to include a ``set -e`` at the
+            beginning of the script. This causes the shell to stop as soon as
+            an error is encountered.
+        environment_file : str
+            If given, the header sources this file (see
+            ``write_environment_file``) instead of containing the module commands
+            and the export variables.
+
+        Returns
+        -------
+        str :
+            The header of the scripts.
         """
+        commands = self.commands
+        headers = self.__dict__.setdefault("_script_headers", {})
+        cached = headers.get((include_set_e, environment_file))
+        if cached and cached[0] is commands and cached[1] == len(commands):
+            return cached[2]
+
         # Check for sh_interpreter
         if "sh_interpreter" not in self.config:
             print('WARNING: "sh_interpreter" not defined in the machine yaml')
-        with open("dummy_script.sh", "w") as script_file:
-            # Write the file headings
-            script_file.write(f'#!{self.config.get("sh_interpreter", "/bin/bash")} -l\n')
-            script_file.write(
-                "# Dummy script generated by esm-tools, to be removed later: \n"
+        # Write the file headings
+        header = [
+            f'#!{self.config.get("sh_interpreter", "/bin/bash")} -l\n',
+            "# Dummy script generated by esm-tools, to be removed later: \n",
+        ]
+        if include_set_e:
+            header.append("set -e\n")
+        # Write the module and export commands, or source them
+        if environment_file:
+            header.append(f"source {shlex.quote(environment_file)}\n")
+        else:
+            header.extend(f"{command}\n" for command in commands)
+        header.append("\n")
+        header = "".join(header)
+
+        headers[(include_set_e, environment_file)] = (commands, len(commands), header)
+        return header
+
+
+    def write_scripts(
+        self,
+        scripts,
+        directory=".",
+        include_set_e=True,
+        shared_environment=False,
+        environment_directory=None,
+    ):
+        """
+        Writes several scripts named ``<name>_script.sh`` in ``directory``, each one
+        containing the header of this environment (see ``script_header``) followed by
+        its commands.
+
+        The header is kept in memory instead of being read from ``dummy_script.sh``,
+        and each script is written to a temporary file and atomically renamed, so
+        this method can be safely called from parallel threads or processes writing
+        in the same directory.
+
+        Parameters
+        ----------
+        scripts : dict
+            Commands (list of str) of each script name (e.g.
+            ``comp_echam-6.3.05``). Scripts without commands are not written.
+        directory : str
+            Directory where the scripts are written. Defaults to the current working
+            directory.
+        include_set_e : bool
+            Default to True, whether or not to include a ``set -e`` at the
+            beginning of the scripts.
+        shared_environment : bool
+            If ``True``, the environment is written once to a shared file that the
+            scripts source, instead of inlining it in each script (see
+            ``write_environment_file``). Defaults to ``False``.
+        environment_directory : str
+            Directory of the shared environment file. Defaults to ``directory``.
+
+        Returns
+        -------
+        paths : dict
+            Path of the script of each name.
+        """
+        environment_file = None
+        if shared_environment:
+            environment_file = self.write_environment_file(
+                environment_directory or directory
             )
-            if include_set_e:
-                script_file.write("set -e\n")
+        header = self.script_header(include_set_e, environment_file)
+        paths = {}
+        for name, commands in scripts.items():
+            paths[name] = os.path.join(directory, f"{name}_script.sh")
+            if commands:
+                write_script(paths[name], header, commands)
+        return paths
 
-            # Write the module and export commands
-            for command in self.commands:
-                script_file.write(f"{command}\n")
-            script_file.write("\n")
+
+    def to_lock(self, path):
+        """
+        Writes the resolved environment into the lockfile ``path``, so that it can be
+        loaded later with ``from_lock`` without resolving the `yaml` files again.
+
+        The lockfile is a compact JSON file containing the format version
+        (``LOCK_VERSION``), the ``fingerprint`` of the inputs computed when this
+        environment was built (see ``lock_fingerprint``), the machine file, the
+        ``LOCK_KEYS`` of ``config`` (``ExportVar`` keys serialised with
+        ``ExportVar.to_dict``) and the ``commands``.
+
+        Parameters
+        ----------
+        path : str
+            Path of the lockfile.
+        """
+        machine_file = getattr(self, "machine_file", None)
+        config = {}
+        for key in LOCK_KEYS:
+            if key not in self.config:
+                continue
+            if key == "export_vars":
+                config[key] = [
+                    [name.to_dict() if isinstance(name, ExportVar) else name, value]
+                    for name, value in self.config[key].items()
+                ]
+            else:
+                config[key] = self.config[key]
+
+        lock = {
+            "version": LOCK_VERSION,
+            "fingerprint": getattr(self, "fingerprint", None),
+            "machine_file": machine_file,
+            "config": config,
+            "commands": self.commands,
+        }
+        cache.atomic_write(
+            path, json.dumps(lock, separators=(",", ":"), default=str) + "\n"
+        )
+
+
+    @classmethod
+    def from_lock(
+        cls,
+        path,
+        run_or_compile=None,
+        complete_config=None,
+        model=None,
+        machine_file=None,
+    ):
+        """
+        Loads an environment from the lockfile ``path`` written by ``to_lock``,
+        without using ``esm_parser``.
+
+        If ``run_or_compile`` is given, the fingerprint of the inputs (see
+        ``lock_fingerprint``) is compared with the one in the lockfile, and a
+        ``ValueError`` is raised if they differ. Otherwise the lockfile is trusted.
+
+        Parameters
+        ----------
+        path : str
+            Path of the lockfile.
+        run_or_compile : str
+            ``compiletime`` or ``runtime``.
+        complete_config : dict
+            Configuration from which the environment would be built.
+        model : str
+            Model for which the environment is required.
+        machine_file : str
+            Machine file used instead of the ``computer`` section. Defaults to the
+            machine file stored in the lockfile.
+
+        Returns
+        -------
+        environment : EnvironmentInfos
+            The environment stored in the lockfile.
+        """
+        with open(path) as f:
+            lock = json.load(f)
+
+        if lock.get("version") != LOCK_VERSION:
+            raise ValueError(
+                f"The environment lockfile {path} has version {lock.get('version')}, "
+                f"but version {LOCK_VERSION} is required"
+            )
+        if run_or_compile:
+            fingerprint = lock_fingerprint(
+                run_or_compile,
+                complete_config,
+                model,
+                machine_file or lock["machine_file"],
+            )
+            if fingerprint is None or fingerprint != lock["fingerprint"]:
+                raise ValueError(
+                    f"The environment lockfile {path} is stale: the environment "
+                    "inputs have changed since it was written"
+                )
+
+        environment = cls.__new__(cls)
+        environment.freeze_modules = False
+        environment.module_command = None
+        environment.timings = timing.NULL_TIMINGS
+        environment.fingerprint = lock["fingerprint"]
+        if lock["machine_file"]:
+            environment.machine_file = lock["machine_file"]
+        config = lock["config"]
+        if "export_vars" in config:
+            config["export_vars"] = {
+                ExportVar.from_dict(name) if isinstance(name, dict) else name: value
+                for name, value in config["export_vars"]
+            }
+        environment.config = config
+        environment.commands = lock["commands"]
+        return environment
 
 
     def remove_computer_from_choose(self, chapter):
@@ -617,15 +2069,18 @@ class EnvironmentInfos:
             ``name`` + "_script.sh"
         """
         if commands:
-            with open(f"{name}_script.sh", "w") as newfile:
-                with open("dummy_script.sh", "r") as dummy_file:
-                    newfile.write(dummy_file.read())
-                for command in commands:
-                    newfile.write(f"{command}\n")
+            with open("dummy_script.sh", "r") as dummy_file:
+                header = dummy_file.read()
+            write_script(f"{name}_script.sh", header, commands)
         return f"{name}_script.sh"
 
     def output(self):
-        esm_parser.pprint_config(self.config)
+        import esm_parser
+
+        config = self.config
+        if isinstance(config, ResolvedEnvironment):
+            config = config.to_dict()
+        esm_parser.pprint_config(config)
 
 
 class environment_infos(EnvironmentInfos):
@@ -0,0 +1,169 @@
+"""
+Frozen environments: instead of running the ``module_actions`` in every generated
+script, they are executed once, the changes they make to the process environment are
+captured, and the scripts only contain plain ``export`` and ``unset`` lines.
+"""
+
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+from . import cache
+
+# Marker separating the different outputs of the capture script
+MARKER = "__ESM_ENVIRONMENT_FROZEN_MARKER__"
+
+# Variables that change with every shell and are not part of the environment
+IGNORED_VARIABLES = {"_", "PWD", "OLDPWD", "SHLVL", "PS1"}
+IGNORED_PREFIXES = ("BASH_FUNC_",)
+
+
+def frozen_commands(
+    module_actions, sh_interpreter="/bin/bash", module_command=None, use_cache=True
+):
+    """
+    Returns the ``export`` and ``unset`` commands that reproduce the changes made to
+    the environment by the ``module_actions``.
+
+    The result is cached on disk, keyed by the ``module_actions``, the
+    ``sh_interpreter``, the ``module_command`` and the current ``MODULEPATH``, so the
+    module actions are only executed again when any of those change.
+
+    Parameters
+    ----------
+    module_actions : list
+        Module actions (e.g. ``load netcdf``), or ``source`` lines.
+    sh_interpreter : str
+        Shell used to run the module actions.
+    module_command : str
+        Command printing the shell code for a module action, as ``modulecmd``
+        does (e.g. ``modulecmd bash`` or ``$LMOD_CMD bash``). The shell function
+        ``module`` is redefined to ``eval`` its output. Defaults to the
+        ``ESM_ENVIRONMENT_MODULE_COMMAND`` environment variable or, if it is not
+        defined, to the ``module`` function of the login shell.
+    use_cache : bool
+        Whether to use the on-disk cache. Defaults to ``True``.
+
+    Returns
+    -------
+    commands : list
+        ``export`` and ``unset`` commands.
+    """
+    if module_command is None:
+        module_command = os.environ.get("ESM_ENVIRONMENT_MODULE_COMMAND")
+
+    use_cache = use_cache and cache.cache_enabled()
+    if use_cache:
+        cache_file = cache.get_cache_dir(
+            "frozen",
+            cache.hash_key(
+                list(module_actions),
+                sh_interpreter,
+                module_command,
+                os.environ.get("MODULEPATH"),
+            )
+            + ".pickle",
+        )
+        commands = cache.read_pickle(cache_file)
+        if isinstance(commands, list):
+            return commands
+
+    before, after = capture_environment(module_actions, sh_interpreter, module_command)
+    commands = environment_diff_commands(before, after)
+
+    if use_cache:
+        cache.write_pickle(cache_file, commands)
+    return commands
+
+
+def capture_environment(
+    module_actions, sh_interpreter="/bin/bash", module_command=None
+):
+    """
+    Runs the ``module_actions`` in a login shell and returns the environment before
+    and after running them.
+
+    Parameters
+    ----------
+    module_actions : list
+        Module actions (e.g. ``load netcdf``), or ``source`` lines.
+    sh_interpreter : str
+        Shell used to run the module actions.
+    module_command : str
+        ``modulecmd``-like command (see ``frozen_commands``).
+
+    Returns
+    -------
+    before, after : dict
+        Environment variables before and after the module actions.
+    """
+    dump_environment = (
+        f"{shlex.quote(sys.executable)} -c "
+        + shlex.quote("import json, os; print(json.dumps(dict(os.environ)))")
+    )
+    lines = []
+    if module_command:
+        lines.append(f'module() {{ eval "$({module_command} "$@")"; }}')
+    lines += [f"echo {MARKER}", dump_environment, f"echo {MARKER}"]
+    for action in module_actions:
+        if action.startswith("source"):
+            lines.append(action)
+        else:
+            lines.append(f"module {action}")
+    lines += [f"echo {MARKER}", dump_environment]
+
+    result = subprocess.run(
+        [sh_interpreter, "-l", "-c", "\n".join(lines)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    # The output is: login shell output, environment before, output of the module
+    # actions and environment after
+    outputs = result.stdout.split(f"{MARKER}\n")
+    if result.returncode != 0 or len(outputs) != 4:
+        print(
+            "ERROR: Could not capture the environment of the module actions:\n"
+            + result.stderr
+        )
+        sys.exit(1)
+
+    return json.loads(outputs[1]), json.loads(outputs[3])
+
+
+def environment_diff_commands(before, after):
+    """
+    Returns the ``export`` and ``unset`` commands to go from the environment
+    ``before`` to the environment ``after``.
+
+    Parameters
+    ----------
+    before : dict
+        Environment variables before.
+    after : dict
+        Environment variables after.
+
+    Returns
+    -------
+    commands : list
+        ``export`` and ``unset`` commands.
+    """
+    commands = []
+    for variable, value in after.items():
+        if ignored_variable(variable):
+            continue
+        if before.get(variable) != value:
+            commands.append(f"export {variable}={shlex.quote(value)}")
+    for variable in before:
+        if variable not in after and not ignored_variable(variable):
+            commands.append(f"unset {variable}")
+    return commands
+
+
+def ignored_variable(variable):
+    """
+    Checks whether ``variable`` should be ignored when comparing environments.
+    """
+    return variable in IGNORED_VARIABLES or variable.startswith(IGNORED_PREFIXES)
@@ -0,0 +1,277 @@
+"""
+Machine files: loading the resolved machine configurations through the
+compiled-machine cache, and finding the machine file of a host through a
+precomputed hostname-to-machine index.
+"""
+
+import os
+import re
+
+from . import cache
+
+# In-process copies of the hostname-to-machine indexes (see ``load_machine_index``)
+MACHINE_INDEXES = {}
+
+
+def resolve_machine_file(machine_file):
+    """
+    Loads the ``machine_file`` and resolves its ``choose_`` blocks and variables.
+
+    Parameters
+    ----------
+    machine_file : str
+        Path to the `yaml` file of the machine.
+
+    Returns
+    -------
+    config : dict
+        The resolved machine configuration.
+    """
+    import esm_parser
+
+    config = esm_parser.yaml_file_to_dict(machine_file)
+    esm_parser.basic_choose_blocks(config, config)
+    esm_parser.recursive_run_function(
+        [],
+        config,
+        "atomic",
+        esm_parser.find_variable,
+        config,
+        [],
+        True,
+    )
+    return config
+
+
+def esm_parser_version():
+    """
+    Returns the version of ``esm_parser``, part of the keys of the on-disk caches.
+    """
+    import esm_parser
+
+    return getattr(esm_parser, "__version__", None)
+
+
+def load_machine_config(machine_file, use_cache=True):
+    """
+    Returns the resolved configuration of ``machine_file`` (see
+    ``resolve_machine_file``), using the compiled-machine cache if possible.
+
+    The resolved dictionary is stored pickled in the user cache directory, keyed by
+    the path, modification time and content hash of the machine file, and by the
+    ``esm_parser`` version. Any change in those invalidates the cached entry, and any
+    problem reading or writing the cache falls back to resolving the file again.
+
+    Parameters
+    ----------
+    machine_file : str
+        Path to the `yaml` file of the machine.
+    use_cache : bool
+        Whether to use the on-disk cache. Defaults to ``True``.
+
+    Returns
+    -------
+    config : dict
+        The resolved machine configuration. This is always a new dictionary that can
+        be modified by the caller.
+    """
+    if not (use_cache and cache.cache_enabled()):
+        return resolve_machine_file(machine_file)
+
+    try:
+        signature = cache.file_signature(machine_file)
+    except OSError:
+        return resolve_machine_file(machine_file)
+    cache_file = cache.get_cache_dir(
+        "machines", cache.hash_key(signature, esm_parser_version()) + ".pickle"
+    )
+
+    config = cache.read_pickle(cache_file)
+    if not isinstance(config, dict):
+        config = resolve_machine_file(machine_file)
+        cache.write_pickle(cache_file, config)
+
+    return config
+
+
+def machines_directory():
+    """
+    Returns the path to the ``machines`` folder of the ``esm_tools`` configuration.
+    """
+    from esm_rcfile import FUNCTION_PATH
+
+    return FUNCTION_PATH + "/machines"
+
+
+def machine_index_signature(machines_dir):
+    """
+    Returns a tuple identifying the current state of ``machines_dir`` and its
+    ``all_machines.yaml`` (modification times and size), or ``None`` if they do not
+    exist.
+    """
+    try:
+        dir_stat = os.stat(machines_dir)
+        all_machines_stat = os.stat(machines_dir + "/all_machines.yaml")
+    except OSError:
+        return None
+    return (
+        os.path.abspath(machines_dir),
+        dir_stat.st_mtime_ns,
+        all_machines_stat.st_mtime_ns,
+        all_machines_stat.st_size,
+    )
+
+
+def build_machine_index(machines_dir):
+    """
+    Reads the hostname patterns of ``all_machines.yaml`` in ``machines_dir``.
+
+    Parameters
+    ----------
+    machines_dir : str
+        Path to the folder with the machine files.
+
+    Returns
+    -------
+    patterns : list
+        ``(pattern, machine_file, match_fqdn)`` tuples, in the order in which
+        ``esm_parser.determine_computer_from_hostname`` checks them. ``match_fqdn``
+        indicates whether the pattern is also checked against the fully qualified
+        domain name of the host.
+    """
+    import esm_parser
+
+    all_machines = esm_parser.yaml_file_to_dict(machines_dir + "/all_machines.yaml")
+    patterns = []
+    for machine, node_patterns in all_machines.items():
+        machine_file = machines_dir + "/" + machine + ".yaml"
+        for node_pattern in node_patterns.values():
+            if isinstance(node_pattern, str):
+                patterns.append((node_pattern, machine_file, True))
+            elif isinstance(node_pattern, (list, tuple)):
+                for pattern in node_pattern:
+                    patterns.append((pattern, machine_file, False))
+    return patterns
+
+
+def load_machine_index(machines_dir):
+    """
+    Returns the hostname-to-machine index of ``machines_dir``: a dictionary with
+    the ``signature`` of the folder (see ``machine_index_signature``), the hostname
+    ``patterns`` (see ``build_machine_index``) and the ``hosts`` already matched.
+
+    The index is kept in memory and pickled in the user cache directory, and it is
+    rebuilt whenever the modification time of the folder or of its
+    ``all_machines.yaml`` changes.
+
+    Returns
+    -------
+    index : dict or None
+        The index, or ``None`` if ``machines_dir`` contains no ``all_machines.yaml``.
+    """
+    signature = machine_index_signature(machines_dir)
+    if signature is None:
+        return None
+
+    index = MACHINE_INDEXES.get(machines_dir)
+    if index is not None and index["signature"] == signature:
+        return index
+
+    index = None
+    if cache.cache_enabled():
+        index = cache.read_pickle(machine_index_file(machines_dir))
+    if not isinstance(index, dict) or index.get("signature") != signature:
+        index = {
+            "signature": signature,
+            "patterns": build_machine_index(machines_dir),
+            "hosts": {},
+        }
+        save_machine_index(machines_dir, index)
+    MACHINE_INDEXES[machines_dir] = index
+    return index
+
+
+def machine_index_file(machines_dir):
+    """
+    Returns the path to the pickled hostname-to-machine index of ``machines_dir``.
+    """
+    return cache.get_cache_dir(
+        "machines", "index_" + cache.hash_key(os.path.abspath(machines_dir)) + ".pickle"
+    )
+
+
+def save_machine_index(machines_dir, index):
+    """
+    Stores the hostname-to-machine ``index`` of ``machines_dir`` in the user cache
+    directory, if the on-disk caches are enabled.
+    """
+    if cache.cache_enabled():
+        cache.write_pickle(machine_index_file(machines_dir), index)
+
+
+def find_machine_file(machines_dir=None, hostname=None):
+    """
+    Returns the machine file of this host, as
+    ``esm_parser.determine_computer_from_hostname`` does, but looking the host up in
+    a precomputed index (see ``load_machine_index``). Hosts matched once are
+    remembered, so that later lookups are a single dictionary access.
+
+    If the host matches no pattern, or the index cannot be built, the lookup falls
+    back to ``esm_parser.determine_computer_from_hostname``.
+
+    Parameters
+    ----------
+    machines_dir : str
+        Path to the folder with the machine files. Defaults to the ``machines``
+        folder of the ``esm_tools`` configuration.
+    hostname : str
+        Name of the host. Defaults to the name of this host. The fallback always
+        uses the name of this host.
+
+    Returns
+    -------
+    machine_file : str
+        Path to the machine file.
+    """
+    import socket
+
+    hostname = hostname or socket.gethostname()
+    try:
+        machines_dir = machines_dir or machines_directory()
+        index = load_machine_index(machines_dir)
+    except Exception:
+        index = None
+    if index is None:
+        return determine_computer_from_hostname()
+
+    machine_file = index["hosts"].get(hostname)
+    if machine_file:
+        return machine_file
+
+    # Check the patterns in order, getting the domain name only if needed
+    fqdn = None
+    for pattern, pattern_machine_file, match_fqdn in index["patterns"]:
+        if re.match(pattern, hostname):
+            machine_file = pattern_machine_file
+        elif match_fqdn:
+            fqdn = fqdn or socket.getfqdn()
+            if re.match(pattern, fqdn):
+                machine_file = pattern_machine_file
+        if machine_file:
+            break
+    else:
+        return determine_computer_from_hostname()
+
+    index["hosts"][hostname] = machine_file
+    save_machine_index(machines_dir, index)
+    return machine_file
+
+
+def determine_computer_from_hostname():
+    """
+    Returns the machine file of this host from
+    ``esm_parser.determine_computer_from_hostname``.
+    """
+    import esm_parser
+
+    return esm_parser.determine_computer_from_hostname()
@@ -0,0 +1,160 @@
+"""
+Generation of the environments for a matrix of machines and model versions, used to
+validate the environments of a release on all the supported machines at once.
+"""
+
+import concurrent.futures
+import copy
+import glob
+import os
+
+from .esm_environment import EnvironmentInfos
+
+
+def find_machine_files(paths):
+    """
+    Returns the machine files in ``paths``. Directories are expanded to their
+    ``*.yaml`` files, excluding ``all_machines.yaml``.
+
+    Parameters
+    ----------
+    paths : list
+        Machine files or directories containing machine files.
+
+    Returns
+    -------
+    machine_files : list
+        Paths to the machine files.
+    """
+    machine_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            machine_files += sorted(
+                machine_file
+                for machine_file in glob.glob(os.path.join(path, "*.yaml"))
+                if os.path.basename(machine_file) != "all_machines.yaml"
+            )
+        else:
+            machine_files.append(path)
+    return machine_files
+
+
+def model_versions(complete_config, run_or_compile):
+    """
+    Returns the versions of each component of ``complete_config`` for which the
+    environment changes: the branches of the ``choose_version`` block in its
+    ``<run_or_compile>_environment_changes``, the only one that
+    ``EnvironmentInfos.apply_model_changes`` selects by ``version``, or, if there
+    are none, its ``version``.
+
+    Parameters
+    ----------
+    complete_config : dict
+        Configuration of the components.
+    run_or_compile : str
+        ``compiletime`` or ``runtime``.
+
+    Returns
+    -------
+    versions : dict
+        List of versions of each component.
+    """
+    versions = {}
+    for model, model_config in complete_config.items():
+        if model in ["computer", "general"] or not isinstance(model_config, dict):
+            continue
+        changes = model_config.get(f"{run_or_compile}_environment_changes")
+        choose_version = {}
+        if isinstance(changes, dict):
+            choose_version = changes.get("choose_version") or {}
+        model_versions = [version for version in choose_version if version != "*"]
+        versions[model] = model_versions or [model_config.get("version")]
+    return versions
+
+
+def environment_tasks(machine_files, complete_config, run_or_compile):
+    """
+    Returns the list of ``(machine_file, model, version, complete_config)`` tasks of
+    the matrix. Without components, there is one task per machine (``model`` and
+    ``version`` are ``None``).
+    """
+    versions = model_versions(complete_config or {}, run_or_compile)
+    tasks = []
+    for machine_file in machine_files:
+        if not versions:
+            tasks.append((machine_file, None, None, {}))
+        for model, model_versions_list in versions.items():
+            for version in model_versions_list:
+                model_config = copy.deepcopy(complete_config[model])
+                if version is not None:
+                    model_config["version"] = version
+                tasks.append((machine_file, model, version, {model: model_config}))
+    return tasks
+
+
+def build_environment(task, run_or_compile):
+    """
+    Builds the environment of one ``task`` of the matrix (see ``environment_tasks``).
+
+    Returns
+    -------
+    list or dict :
+        The environment commands, or ``{"error": message}`` if the environment could
+        not be built.
+    """
+    machine_file, model, _, complete_config = task
+    try:
+        environment = EnvironmentInfos(
+            run_or_compile, complete_config, model, machine_file=machine_file
+        )
+        return environment.commands
+    except (Exception, SystemExit) as error:
+        return {"error": f"{type(error).__name__}: {error}"}
+
+
+def environment_matrix(
+    machine_files, complete_config=None, run_or_compile="compiletime", processes=None
+):
+    """
+    Generates the environment commands for every machine in ``machine_files`` and
+    every version of every component of ``complete_config`` (see
+    ``model_versions``), distributing the work over a pool of processes.
+
+    Parameters
+    ----------
+    machine_files : list
+        Machine files or directories containing them (see ``find_machine_files``).
+    complete_config : dict
+        Configuration of the components. If not given, only the environments of
+        the machines are generated.
+    run_or_compile : str
+        ``compiletime`` or ``runtime``. Defaults to ``compiletime``.
+    processes : int
+        Number of worker processes. Defaults to the number of CPUs. With ``1``
+        the environments are generated in the current process.
+
+    Returns
+    -------
+    matrix : dict
+        ``{machine: {model: {version: commands}}}``, where ``machine`` is the name
+        of the machine file without extension, and ``model`` and ``version`` are
+        ``"None"`` when no components are given. Environments that could not be
+        built contain ``{"error": message}`` instead of the commands.
+    """
+    tasks = environment_tasks(
+        find_machine_files(machine_files), complete_config, run_or_compile
+    )
+    run_or_compiles = [run_or_compile] * len(tasks)
+    if processes == 1:
+        results = list(map(build_environment, tasks, run_or_compiles))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(build_environment, tasks, run_or_compiles))
+
+    matrix = {}
+    for (machine_file, model, version, _), commands in zip(tasks, results):
+        machine = os.path.splitext(os.path.basename(machine_file))[0]
+        matrix.setdefault(machine, {}).setdefault(str(model), {})[
+            str(version)
+        ] = commands
+    return matrix
@@ -0,0 +1,153 @@
+"""
+Optimisation pass over a resolved environment, that removes module actions and
+exports that have no effect in the generated scripts.
+
+Only changes that are safe under the usual module-system semantics are done:
+
+- A ``load`` of modules that were all loaded by the previous ``load`` action, with
+  no other action in between, is removed (loading a loaded module is a no-op).
+  Modules loaded earlier are not tracked, as a later ``load`` may have swapped
+  them (e.g. ``load intel/19`` replaces ``intel/18`` under Lmod).
+- Any other action (``unload``, ``purge``, ``source`` lines...) resets what is
+  known about the loaded modules. In particular, ``load X`` followed by
+  ``unload X`` is kept: the prerequisites loaded by ``X`` stay loaded after the
+  ``unload`` under Tcl modules and Lmod.
+
+- An export is removed if the same variable is exported again later (or unset) and
+  no export in between, nor the later one, references its value. Exports containing
+  command substitutions are assumed to reference any variable.
+"""
+
+import re
+
+from .esm_environment import ExportVar, INDEX_PATTERN, LIST_SUFFIX
+
+LOAD_ACTIONS = {"load", "add"}
+
+
+def optimize_environment(config):
+    """
+    Removes the redundant ``module_actions`` and shadowed ``export_vars`` of
+    ``config`` in place.
+
+    Parameters
+    ----------
+    config : dict
+        Resolved environment configuration (``EnvironmentInfos.config``).
+
+    Returns
+    -------
+    report : list
+        One dictionary per removed item, with its ``kind`` (``module_action`` or
+        ``export``), the removed ``item`` and the ``reason``.
+    """
+    report = []
+    if config.get("module_actions"):
+        config["module_actions"], removed = optimize_module_actions(
+            config["module_actions"]
+        )
+        report += removed
+    if isinstance(config.get("export_vars"), dict):
+        config["export_vars"], removed = optimize_exports(
+            config["export_vars"], config.get("unset_vars", [])
+        )
+        report += removed
+    return report
+
+
+def optimize_module_actions(module_actions):
+    """
+    Returns the ``module_actions`` without the redundant actions, and the report of
+    the removed ones (see ``optimize_environment``).
+    """
+    kept = []
+    removed = []
+    # Modules loaded by the previous action, if it was a ``load``
+    last_loaded = set()
+    for action in module_actions:
+        words = action.split()
+        command, modules = (words[0], words[1:]) if words else ("", [])
+
+        if command in LOAD_ACTIONS and modules:
+            if all(module in last_loaded for module in modules):
+                removed.append(report_item("module_action", action, "already loaded"))
+                continue
+            last_loaded = set(modules)
+        else:
+            # ``unload``, ``purge``, ``source`` lines, ``switch``... can change
+            # anything
+            last_loaded = set()
+        kept.append(action)
+    return kept, removed
+
+
+def optimize_exports(export_vars, unset_vars=()):
+    """
+    Returns the ``export_vars`` without the exports shadowed by a later export or
+    unset of the same variable, and the report of the removed ones (see
+    ``optimize_environment``).
+    """
+    entries = [
+        (key, value, export_name(key, value)) for key, value in export_vars.items()
+    ]
+    unset_vars = set(unset_vars or [])
+
+    removed_keys = set()
+    removed = []
+    # Walk backwards remembering the variables that are overwritten later, and
+    # forgetting them as soon as an export references them
+    overwritten = set(unset_vars)
+    for key, value, name in reversed(entries):
+        if name in overwritten:
+            removed_keys.add(id(key))
+            removed.append(report_item("export", export_item(key, value), "shadowed"))
+            continue
+        overwritten.add(name)
+        overwritten -= referenced_names(value, overwritten)
+    removed.reverse()
+
+    return (
+        {key: value for key, value, _ in entries if id(key) not in removed_keys},
+        removed,
+    )
+
+
+def export_name(key, value):
+    """
+    Returns the name of the variable exported by the entry ``key: value`` of
+    ``export_vars``.
+    """
+    if isinstance(key, ExportVar) or str(key).endswith(LIST_SUFFIX):
+        return str(value).partition("=")[0]
+    match = INDEX_PATTERN.search(key)
+    return key[:match.start()] if match else key
+
+
+def export_item(key, value):
+    """
+    Returns the ``NAME=value`` representation of an entry of ``export_vars``.
+    """
+    if isinstance(key, ExportVar) or str(key).endswith(LIST_SUFFIX):
+        return str(value)
+    return f"{export_name(key, value)}={value}"
+
+
+def referenced_names(value, names):
+    """
+    Returns the subset of ``names`` referenced in ``value`` (as ``$NAME`` or
+    ``${NAME...}``). Values with command substitutions reference all ``names``.
+    """
+    value = str(value)
+    if "$(" in value or "`" in value:
+        return set(names)
+    if "$" not in value:
+        return set()
+    return {name for name in names if reference_pattern(name).search(value)}
+
+
+def reference_pattern(name):
+    return re.compile(r"\$\{?" + re.escape(name) + r"(?![A-Za-z0-9_])")
+
+
+def report_item(kind, item, reason):
+    return {"kind": kind, "item": item, "reason": reason}
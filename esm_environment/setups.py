@@ -0,0 +1,186 @@
+"""
+Setup files: loading a setup file and its attachments, cached in memory for the
+rest of the process.
+"""
+
+import os
+import sys
+
+from . import cache
+
+# In-process cache of the loaded and attached setup files (see ``load_setup_config``)
+SETUP_CONFIG_CACHE = cache.LRUCache(maxsize=16)
+
+
+def load_setup_config(setup, version):
+    """
+    Finds and loads the file of the ``setup`` with the given ``version``, and attaches
+    its attachment files (``esm_parser.CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE``, e.g.
+    ``further_reading``).
+
+    The result is cached in ``SETUP_CONFIG_CACHE`` for the rest of the process,
+    together with the modification times of the loaded files (including the nested
+    attachments, see ``attachment_files``), so that the file system search and the
+    `yaml` parsing are done only once. The cached entry is discarded if any of those
+    files changes. If an attachment file cannot be located, the result is not cached.
+
+    Parameters
+    ----------
+    setup : str
+        Name of the setup (e.g. ``awicm``).
+    version : str
+        Version of the setup.
+
+    Returns
+    -------
+    setup_config : dict
+        The setup configuration. This dictionary is shared between calls and must
+        not be modified.
+    """
+    import esm_parser
+
+    cached = SETUP_CONFIG_CACHE.get((setup, version))
+    if cached and files_unchanged(cached["files"]):
+        return cached["config"]
+
+    # Find the setup file
+    include_path, needs_load = esm_parser.look_for_file(
+        setup,
+        setup + "-" + version,
+    )
+    # If setup file not found throw and error TODO: logging
+    if not include_path:
+        print(f"File for {setup}-{version} not found")
+        sys.exit(1)
+    # Load the file TODO: logging
+    if needs_load:
+        setup_config = esm_parser.yaml_file_to_dict(include_path)
+    else:
+        print(f"A setup needs to load a file so this line shouldn't be reached")
+        sys.exit(1)
+
+    # Add the attachment files (e.g. the environment variables can be in a
+    # further_reading file)
+    loaded_files = [include_path]
+    # Whether all the loaded files are known, so that the result can be cached
+    cacheable = True
+    for attachment in esm_parser.CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE:
+        # Add the attachment file chapters (e.g. there is a further_reading chapter
+        # at the same level of general and the components)
+        files = attachment_files(setup_config, attachment, include_path, setup)
+        cacheable = cacheable and files is not None
+        loaded_files += files or []
+        esm_parser.attach_to_config_and_remove(setup_config, attachment)
+        # Add the attachment files in each chapter (i.e. in general, components,
+        # etc.)
+        for component in list(setup_config):
+            files = attachment_files(
+                setup_config[component], attachment, include_path, setup
+            )
+            cacheable = cacheable and files is not None
+            loaded_files += files or []
+            esm_parser.attach_to_config_and_remove(
+                setup_config[component],
+                attachment,
+            )
+
+    if cacheable:
+        SETUP_CONFIG_CACHE.put(
+            (setup, version),
+            {"config": setup_config, "files": file_mtimes(loaded_files)},
+        )
+    return setup_config
+
+
+def attachment_files(chapter, attachment, include_path, setup, _seen=None):
+    """
+    Returns the paths of the files listed under ``attachment`` in ``chapter``, and of
+    the files they attach themselves, or ``None`` if any of them cannot be located
+    (see ``find_attachment_file``).
+
+    Parameters
+    ----------
+    chapter : dict
+        Chapter of the configuration that may contain the ``attachment`` key.
+    attachment : str
+        Attachment key (e.g. ``further_reading``).
+    include_path : str
+        Path of the file ``chapter`` was loaded from.
+    setup : str
+        Name of the setup, used by ``esm_parser.look_for_file``.
+
+    Returns
+    -------
+    list or None :
+        Paths of the attachment files.
+    """
+    import esm_parser
+
+    if not isinstance(chapter, dict) or attachment not in chapter:
+        return []
+    files = chapter[attachment]
+    if isinstance(files, str):
+        files = [files]
+    if not isinstance(files, list):
+        return []
+
+    seen = set() if _seen is None else _seen
+    found = []
+    for attachment_file in files:
+        path = find_attachment_file(str(attachment_file), include_path, setup)
+        if path is None:
+            return None
+        found.append(path)
+        if path in seen:
+            continue
+        seen.add(path)
+        # Attachments of the attached file, at its top level and in its chapters
+        attached = esm_parser.yaml_file_to_dict(path)
+        chapters = [attached]
+        if isinstance(attached, dict):
+            chapters += list(attached.values())
+        for attached_chapter in chapters:
+            nested = attachment_files(attached_chapter, attachment, path, setup, seen)
+            if nested is None:
+                return None
+            found += nested
+    return found
+
+
+def find_attachment_file(attachment_file, include_path, setup):
+    """
+    Returns the path of ``attachment_file``: as found by
+    ``esm_parser.look_for_file``, or else as given, next to ``include_path`` or in
+    the ``esm_tools`` configuration folder. Returns ``None`` if it is not found.
+    """
+    import esm_parser
+    from esm_rcfile import FUNCTION_PATH
+
+    path, _ = esm_parser.look_for_file(setup, attachment_file)
+    if path and os.path.isfile(path):
+        return path
+    for search_dir in ["", os.path.dirname(include_path), FUNCTION_PATH]:
+        path = os.path.join(search_dir, attachment_file)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def file_mtimes(paths):
+    """
+    Returns a dictionary with the modification time of each of the ``paths``.
+    """
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def files_unchanged(mtimes):
+    """
+    Checks that the files in ``mtimes`` (see ``file_mtimes``) have not been modified.
+    """
+    return file_mtimes(mtimes) == mtimes
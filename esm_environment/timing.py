@@ -0,0 +1,175 @@
+"""
+Opt-in instrumentation of the phases of ``EnvironmentInfos`` (machine-file loading,
+general environment, component changes, ``choose_`` resolution, command
+generation...).
+
+Pass a ``PhaseTimings`` object (or a callback, that is wrapped in one) as the
+``timings`` argument of ``EnvironmentInfos`` to collect the durations. When no
+``timings`` are given, ``NULL_TIMINGS`` is used, which does nothing.
+"""
+
+import json
+import os
+import time
+
+
+class PhaseTimings:
+    """
+    Collects the durations of the phases of the environment generation.
+
+    Parameters
+    ----------
+    callback : callable
+        Optional hook called as ``callback(record)`` after each phase, where
+        ``record`` is the dictionary described in ``records``.
+
+    Attributes
+    ----------
+    records : list
+        One dictionary per finished phase with the ``phase`` name, the
+        ``component`` it applies to (or ``None``), and its ``start`` and
+        ``duration`` in seconds (``start`` is relative to the creation of this
+        object).
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+        self._origin = time.perf_counter()
+
+    def phase(self, name, component=None):
+        """
+        Returns a context manager that records the duration of the phase ``name``
+        for ``component``.
+        """
+        return _Phase(self, name, component)
+
+    def add(self, name, start, duration, component=None):
+        """
+        Adds a record for the phase ``name``, that started at ``start`` (as returned
+        by ``time.perf_counter``) and took ``duration`` seconds.
+        """
+        record = {
+            "phase": name,
+            "component": component,
+            "start": start - self._origin,
+            "duration": duration,
+        }
+        self.records.append(record)
+        if self.callback:
+            self.callback(record)
+
+    def totals(self):
+        """
+        Returns the total duration in seconds of each phase, and of each phase per
+        component (as ``<phase>/<component>``).
+        """
+        totals = {}
+        for record in self.records:
+            names = [record["phase"]]
+            if record["component"] is not None:
+                names.append(f"{record['phase']}/{record['component']}")
+            for name in names:
+                totals[name] = totals.get(name, 0.0) + record["duration"]
+        return totals
+
+    def to_json(self, path=None):
+        """
+        Returns the records and totals as a JSON string, and writes it to ``path``
+        if given.
+        """
+        return self._dump({"records": self.records, "totals": self.totals()}, path)
+
+    def to_chrome_trace(self, path=None):
+        """
+        Returns the records in Chrome trace format (viewable in
+        ``chrome://tracing`` or Perfetto) as a JSON string, and writes it to
+        ``path`` if given.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": record["phase"],
+                "cat": "esm_environment",
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["duration"] * 1e6,
+                "pid": pid,
+                "tid": 0,
+                "args": {"component": record["component"]},
+            }
+            for record in self.records
+        ]
+        return self._dump({"traceEvents": events, "displayTimeUnit": "ms"}, path)
+
+    @staticmethod
+    def _dump(data, path):
+        text = json.dumps(data, indent=4)
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+
+class _Phase:
+    """
+    Context manager measuring one phase for ``PhaseTimings``.
+    """
+
+    __slots__ = ("timings", "name", "component", "start")
+
+    def __init__(self, timings, name, component):
+        self.timings = timings
+        self.name = name
+        self.component = component
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(
+            self.name, self.start, time.perf_counter() - self.start, self.component
+        )
+        return False
+
+
+class _NullPhase:
+    """
+    Context manager that does nothing, used when the instrumentation is disabled.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullTimings:
+    """
+    ``PhaseTimings`` replacement that does not record anything.
+    """
+
+    _null_phase = _NullPhase()
+
+    def phase(self, name, component=None):
+        return self._null_phase
+
+
+NULL_TIMINGS = _NullTimings()
+
+
+def get_timings(timings):
+    """
+    Returns the timings object to use for the ``timings`` argument of
+    ``EnvironmentInfos``: ``NULL_TIMINGS`` if ``None``, a ``PhaseTimings`` with
+    ``timings`` as callback if it is callable, or ``timings`` itself.
+    """
+    if timings is None:
+        return NULL_TIMINGS
+    if callable(timings) and not hasattr(timings, "phase"):
+        return PhaseTimings(callback=timings)
+    return timings
@@ -36,6 +36,11 @@ setup(
         "Programming Language :: Python :: 3.8",
     ],
     description="ESM Environment python package to assemble environment information for compiling and running ESMs",
+    entry_points={
+        "console_scripts": [
+            "esm_environment_matrix=esm_environment.cli:main",
+        ],
+    },
     install_requires=requirements,
     license="GNU General Public License v2",
     long_description=readme + "\n\n" + history,
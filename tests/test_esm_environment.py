@@ -3,9 +3,37 @@
 """Tests for `esm_environment` package."""
 
 
+import copy
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
 import unittest
+from unittest import mock
 
 from esm_environment import esm_environment
+from esm_environment import cache
+from esm_environment import frozen
+from esm_environment import machines
+from esm_environment import matrix
+from esm_environment import optimize
+from esm_environment import setups
+from esm_environment import timing
+
+
+def export_records(export_vars):
+    """
+    Returns the keys of ``export_vars``, with the fields of the ``ExportVar`` keys
+    (including the ones that are not part of their equality, e.g. ``component``).
+    """
+    return [
+        key.to_dict() if isinstance(key, esm_environment.ExportVar) else key
+        for key in export_vars
+    ]
 
 
 class TestEsm_environment(unittest.TestCase):
@@ -19,3 +47,1310 @@ class TestEsm_environment(unittest.TestCase):
 
     def test_000_something(self):
         """Test something."""
+
+
+class TestIncrementalChoose(unittest.TestCase):
+    """
+    Tests that the incremental resolution of ``choose_`` blocks in
+    ``apply_model_changes`` is equivalent to resolving the whole config.
+    """
+
+    def setUp(self):
+        """Find the machine files shipped with ``esm_tools``."""
+        try:
+            from esm_rcfile import FUNCTION_PATH
+        except ImportError:
+            self.skipTest("esm_rcfile is needed to find the esm_tools machine files")
+
+        machines_dir = os.path.join(FUNCTION_PATH, "machines")
+        if not os.path.isdir(machines_dir):
+            self.skipTest(f"No machine files found in {machines_dir}")
+        self.machine_files = sorted(
+            os.path.join(machines_dir, machine_file)
+            for machine_file in os.listdir(machines_dir)
+            if machine_file.endswith(".yaml") and machine_file != "all_machines.yaml"
+        )
+
+    def components(self, machine_name):
+        """Components with choose_ blocks and add_ entries in their environments."""
+        return {
+            "fesom": {
+                "version": "2.0",
+                "environment_changes": {
+                    "add_module_actions": ["load fesom_module"],
+                    "add_export_vars": ["FESOM_VAR=1", "FESOM_VAR=1"],
+                    "choose_computer.name": {
+                        machine_name: {"add_export_vars": {"MACHINE_VAR": "yes"}},
+                        "*": {"add_unset_vars": ["NOT_THIS_MACHINE"]},
+                    },
+                },
+            },
+            "echam": {
+                "version": "6.3.05p2",
+                "compiletime_environment_changes": {
+                    "choose_version": {
+                        "6.3.05p2": {"add_export_vars": {"ECHAM_VERSION": "p2"}},
+                    },
+                    "choose_computer.name": {
+                        machine_name: {"add_module_actions": ["load echam_module"]},
+                    },
+                },
+            },
+        }
+
+    def build(self, machine_config, incremental):
+        environment = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        environment.incremental_choose = incremental
+        components = self.components(machine_config.get("name"))
+        environment.load_computer({"computer": copy.deepcopy(machine_config)})
+        for model in components:
+            environment.apply_config_changes("compiletime", components, model)
+        # Compare the ``ExportVar`` keys including the fields that are not part of
+        # their equality (e.g. ``component``)
+        config = dict(environment.config)
+        export_vars = config.get("export_vars", {})
+        config["export_vars"] = list(
+            zip(export_records(export_vars), export_vars.values())
+        )
+        return config
+
+    def test_incremental_choose_matches_full_resolution(self):
+        """Test both resolutions on all the machine files."""
+        for machine_file in self.machine_files:
+            with self.subTest(machine_file=os.path.basename(machine_file)):
+                machine_config = machines.resolve_machine_file(machine_file)
+                self.assertEqual(
+                    self.build(machine_config, incremental=True),
+                    self.build(machine_config, incremental=False),
+                )
+
+
+class TestForModels(unittest.TestCase):
+    """
+    Tests that ``EnvironmentInfos.for_models`` is identical to instancing
+    ``EnvironmentInfos`` for each model.
+    """
+
+    def setUp(self):
+        """Skip if ``esm_parser`` is not available."""
+        if importlib.util.find_spec("esm_parser") is None:
+            self.skipTest("esm_parser is needed to apply the environment changes")
+
+    def complete_config(self):
+        return {
+            "computer": {
+                "name": "machine",
+                "sh_interpreter": "/bin/bash",
+                "module_actions": ["purge", "load intel"],
+                "export_vars": {"CC": "icc"},
+                "partitions": {"compute": {"cores_per_node": 128}},
+            },
+            "general": {"models": ["fesom", "echam"]},
+            "fesom": {
+                "version": "2.0",
+                "environment_changes": {
+                    "add_module_actions": ["load netcdf"],
+                    "add_export_vars": {"FESOM_VAR": "1"},
+                },
+            },
+            "echam": {
+                "version": "6.3.05p2",
+                "compiletime_environment_changes": {
+                    "choose_version": {
+                        "6.3.05p2": {"add_export_vars": {"ECHAM_VERSION": "p2"}},
+                    },
+                    "add_unset_vars": ["CC"],
+                },
+            },
+        }
+
+    def test_for_models(self):
+        """Test the ``config`` and ``commands`` of each model."""
+        complete_config = self.complete_config()
+        environments = esm_environment.EnvironmentInfos.for_models(
+            "compiletime", complete_config
+        )
+        self.assertEqual(complete_config, self.complete_config())
+        self.assertEqual(sorted(environments), ["echam", "fesom"])
+        for model, environment in environments.items():
+            with self.subTest(model=model):
+                expected = esm_environment.EnvironmentInfos(
+                    "compiletime", self.complete_config(), model
+                )
+                self.assertEqual(environment.commands, expected.commands)
+                self.assertEqual(
+                    export_records(environment.config["export_vars"]),
+                    export_records(expected.config["export_vars"]),
+                )
+                self.assertEqual(environment.config, expected.config)
+        # The entries not modified by the models are shared
+        self.assertIs(
+            environments["fesom"].config["partitions"],
+            environments["echam"].config["partitions"],
+        )
+
+
+class TestFrozenEnvironment(unittest.TestCase):
+    """
+    Tests the frozen environments, using a ``modulecmd`` stub instead of the module
+    system of the machine.
+    """
+
+    def setUp(self):
+        """Write the ``modulecmd`` stub."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.module_command = os.path.join(self.tmp_dir, "modulecmd")
+        with open(self.module_command, "w") as stub:
+            stub.write(
+                "#!/bin/sh\n"
+                "shift\n"
+                'case "$1" in\n'
+                '  load) echo "export STUB_$2=loaded" ;;\n'
+                '  unload) echo "unset STUB_$2" ;;\n'
+                "esac\n"
+            )
+        os.chmod(self.module_command, 0o755)
+
+    def tearDown(self):
+        """Remove the stub."""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frozen_commands(self):
+        """Test that the module actions are replaced by their exports."""
+        commands = frozen.frozen_commands(
+            ["load netcdf", "load hdf5", "unload netcdf"],
+            module_command=f"{self.module_command} bash",
+            use_cache=False,
+        )
+        self.assertEqual(commands, ["export STUB_hdf5=loaded"])
+
+
+class TestLazyImport(unittest.TestCase):
+    """Tests that importing the package does not import its heavy dependencies."""
+
+    def setUp(self):
+        """Put importable ``esm_parser`` and ``esm_rcfile`` stubs on the path."""
+        self.tmpdir = tempfile.mkdtemp()
+        for module in ["esm_parser", "esm_rcfile"]:
+            with open(os.path.join(self.tmpdir, module + ".py"), "w") as f:
+                f.write("FUNCTION_PATH = ''\n")
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.env = dict(
+            os.environ, PYTHONPATH=os.pathsep.join([self.tmpdir, package_dir])
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_python(self, code):
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            env=self.env,
+            check=True,
+        )
+        return result.stdout.split()
+
+    def test_import_does_not_load_esm_parser(self):
+        """Test that ``esm_parser`` is only imported when needed."""
+        code = (
+            "import sys, esm_environment; "
+            "print('esm_parser' in sys.modules or 'esm_rcfile' in sys.modules); "
+            "import esm_parser, esm_rcfile; "
+            "print('esm_parser' in sys.modules and 'esm_rcfile' in sys.modules)"
+        )
+        self.assertEqual(self.run_python(code), ["False", "True"])
+
+    def test_submodule_access(self):
+        """Test that the submodule is available on first access."""
+        code = (
+            "import esm_environment; "
+            "print(esm_environment.esm_environment.EnvironmentInfos.__name__)"
+        )
+        self.assertEqual(self.run_python(code), ["EnvironmentInfos"])
+
+    def test_star_import(self):
+        """Test that ``from esm_environment import *`` exports the classes."""
+        namespace = {}
+        exec("from esm_environment import *", namespace)
+        self.assertIs(namespace["EnvironmentInfos"], esm_environment.EnvironmentInfos)
+        self.assertIs(
+            namespace["environment_infos"], esm_environment.environment_infos
+        )
+
+
+class TestAddExportVarsToDict(unittest.TestCase):
+    """Tests the transformation of ``add_export_vars`` lists into dictionaries."""
+
+    def test_nested_lists_with_repetitions(self):
+        """Test that repeated elements are kept as different records."""
+        environment = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        modelconfig = {
+            "environment_changes": {
+                "add_export_vars": ["A=1", "B=2", "A=1"],
+                "choose_computer.name": {
+                    "ollie": {"add_export_vars": ["C=3", "C=3", "C=3"]},
+                    "levante": {"add_export_vars": {"D": "4"}},
+                },
+            }
+        }
+        environment.turn_add_export_vars_to_dict(modelconfig, "add_export_vars")
+        changes = modelconfig["environment_changes"]
+        records = list(changes["add_export_vars"])
+        self.assertEqual(
+            list(changes["add_export_vars"].values()), ["A=1", "B=2", "A=1"]
+        )
+        self.assertEqual(
+            [(r.name, r.value, r.index) for r in records],
+            [("A", "1", 0), ("B", "2", 0), ("A", "1", 1)],
+        )
+        self.assertTrue(all(isinstance(r, esm_environment.ExportVar) for r in records))
+        ollie_records = changes["choose_computer.name"]["ollie"]["add_export_vars"]
+        self.assertEqual([record.index for record in ollie_records], [0, 1, 2])
+        self.assertEqual(
+            changes["choose_computer.name"]["levante"]["add_export_vars"], {"D": "4"}
+        )
+
+    def test_export_commands(self):
+        """Test the export commands of the records and the legacy encoded keys."""
+        environment = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        modelconfig = {"environment_changes": {"add_export_vars": ["A=1", "A=1", "B"]}}
+        environment.turn_add_export_vars_to_dict(modelconfig, "add_export_vars")
+        export_vars = {
+            "PATH": "/bin",
+            "PATH[(1)]": "$PATH:/opt/bin",
+            "C=3[(0)][(list)]": "C=3",
+        }
+        export_vars.update(modelconfig["environment_changes"]["add_export_vars"])
+        environment.config = {"export_vars": export_vars}
+        self.assertEqual(
+            environment.get_shell_commands(),
+            [
+                "",
+                "export PATH=/bin",
+                "export PATH=$PATH:/opt/bin",
+                "export C=3",
+                "export A=1",
+                "export A=1",
+                "export B",
+                "",
+            ],
+        )
+
+
+    def test_duplicates_across_components(self):
+        """Test that an element added by two components is exported once."""
+        environment = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        export_vars = {"CC": "icc"}
+        for component in ["fesom", "echam"]:
+            modelconfig = {
+                "environment_changes": {
+                    "add_export_vars": ["OMP_NUM_THREADS=1", "PATH=$PATH:/x"]
+                }
+            }
+            environment.turn_add_export_vars_to_dict(
+                modelconfig, "add_export_vars", component
+            )
+            export_vars.update(modelconfig["environment_changes"]["add_export_vars"])
+        environment.config = {"export_vars": export_vars}
+
+        self.assertEqual(
+            environment.get_shell_commands(),
+            [
+                "",
+                "export CC=icc",
+                "export OMP_NUM_THREADS=1",
+                "export PATH=$PATH:/x",
+                "",
+            ],
+        )
+        # The records are equal to the historical string keys
+        self.assertIn("OMP_NUM_THREADS=1[(0)][(list)]", export_vars)
+        self.assertEqual(
+            [record.component for record in environment.exports()[1:]],
+            ["fesom", "fesom"],
+        )
+        record = list(export_vars)[1]
+        self.assertEqual(copy.deepcopy(record).to_dict(), record.to_dict())
+
+
+class TestOptimize(unittest.TestCase):
+    """Tests the removal of redundant module actions and shadowed exports."""
+
+    def test_module_actions(self):
+        """Test that only provably redundant module actions are removed."""
+        actions, removed = optimize.optimize_module_actions(
+            [
+                "load intel",
+                "purge",
+                "load netcdf",
+                "unload netcdf",
+                "load hdf5",
+                "load hdf5",
+                "source setup.sh",
+                "load hdf5",
+                "unload hdf5",
+            ]
+        )
+        # ``load``/``unload`` pairs are kept, as the prerequisites loaded by the
+        # module stay loaded
+        self.assertEqual(
+            actions,
+            [
+                "load intel",
+                "purge",
+                "load netcdf",
+                "unload netcdf",
+                "load hdf5",
+                "source setup.sh",
+                "load hdf5",
+                "unload hdf5",
+            ],
+        )
+        self.assertEqual([item["item"] for item in removed], ["load hdf5"])
+
+    def test_module_version_swaps(self):
+        """Test that loads after a different load are kept (e.g. version swaps)."""
+        module_actions = [
+            "load intel/18",
+            "load intel/19",
+            "load intel/18",
+            "load netcdf",
+            "load intel/18",
+        ]
+        actions, removed = optimize.optimize_module_actions(module_actions)
+        self.assertEqual(actions, module_actions)
+        self.assertEqual(removed, [])
+
+    def test_exports(self):
+        """Test that shadowed exports are removed unless they are referenced."""
+        export_vars, removed = optimize.optimize_exports(
+            {
+                "CC": "gcc",
+                "CC[(1)]": "icc",
+                "PATH": "/opt/bin",
+                "PATH[(1)]": "$PATH:/usr/bin",
+                "TMP": "/tmp",
+            },
+            unset_vars=["TMP"],
+        )
+        self.assertEqual(
+            export_vars,
+            {"CC[(1)]": "icc", "PATH": "/opt/bin", "PATH[(1)]": "$PATH:/usr/bin"},
+        )
+        self.assertEqual([item["item"] for item in removed], ["CC=gcc", "TMP=/tmp"])
+
+
+class TestMatrix(unittest.TestCase):
+    """Tests for the tasks of ``matrix.environment_matrix``."""
+
+    def test_model_versions(self):
+        """Test that one task is created per machine and version of the components."""
+        complete_config = {
+            "general": {},
+            "fesom": {
+                "version": "2.0",
+                "environment_changes": {"choose_version": {"3.0": {}}},
+                "compiletime_environment_changes": {
+                    "choose_version": {"2.0": {}, "1.4": {}, "*": {}},
+                },
+            },
+            "echam": {
+                "version": "6.3",
+                "environment_changes": {"choose_version": {"6.1": {}}},
+            },
+        }
+        # Only the ``choose_version`` of ``<run_or_compile>_environment_changes``
+        # is selected by the ``version`` in ``apply_model_changes``
+        self.assertEqual(
+            matrix.model_versions(complete_config, "compiletime"),
+            {"fesom": ["2.0", "1.4"], "echam": ["6.3"]},
+        )
+        self.assertEqual(
+            matrix.model_versions(complete_config, "runtime"),
+            {"fesom": ["2.0"], "echam": ["6.3"]},
+        )
+        tasks = matrix.environment_tasks(
+            ["a.yaml", "b.yaml"], complete_config, "compiletime"
+        )
+        self.assertEqual(
+            [(task[0], task[1], task[2]) for task in tasks],
+            [
+                ("a.yaml", "fesom", "2.0"),
+                ("a.yaml", "fesom", "1.4"),
+                ("a.yaml", "echam", "6.3"),
+                ("b.yaml", "fesom", "2.0"),
+                ("b.yaml", "fesom", "1.4"),
+                ("b.yaml", "echam", "6.3"),
+            ],
+        )
+        self.assertEqual(tasks[1][3]["fesom"]["version"], "1.4")
+        self.assertEqual(complete_config["fesom"]["version"], "2.0")
+
+
+class TestMachineCache(unittest.TestCase):
+    """Tests for the on-disk cache of ``load_machine_config``."""
+
+    def setUp(self):
+        """Count the resolutions of a machine file, with a temporary cache dir."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.machine_file = os.path.join(self.tmpdir, "machine.yaml")
+        with open(self.machine_file, "w") as f:
+            f.write("name: machine\n")
+        self.environ = dict(os.environ)
+        os.environ.pop("ESM_ENVIRONMENT_NO_CACHE", None)
+        os.environ["ESM_ENVIRONMENT_CACHE_DIR"] = os.path.join(self.tmpdir, "cache")
+
+        self.resolved = []
+
+        def resolve_machine_file(machine_file):
+            with open(machine_file) as f:
+                content = f.read()
+            self.resolved.append(content)
+            return {"content": content}
+
+        self.resolve_machine_file = machines.resolve_machine_file
+        self.esm_parser_version = machines.esm_parser_version
+        machines.resolve_machine_file = resolve_machine_file
+        machines.esm_parser_version = lambda: "1.0"
+
+    def tearDown(self):
+        machines.resolve_machine_file = self.resolve_machine_file
+        machines.esm_parser_version = self.esm_parser_version
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        """Test that the cached config is reused and is a new dictionary."""
+        config = machines.load_machine_config(self.machine_file)
+        config["content"] = "modified"
+        cached = machines.load_machine_config(self.machine_file)
+        self.assertEqual(cached, {"content": "name: machine\n"})
+        self.assertEqual(len(self.resolved), 1)
+
+        machines.load_machine_config(self.machine_file, use_cache=False)
+        self.assertEqual(len(self.resolved), 2)
+
+    def test_invalidation(self):
+        """Test that changes in the file or in ``esm_parser`` invalidate the cache."""
+        machines.load_machine_config(self.machine_file)
+
+        # Only the modification time changes
+        stat = os.stat(self.machine_file)
+        os.utime(
+            self.machine_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9)
+        )
+        machines.load_machine_config(self.machine_file)
+        self.assertEqual(len(self.resolved), 2)
+
+        # The content changes, but not the size nor the modification time
+        stat = os.stat(self.machine_file)
+        with open(self.machine_file, "w") as f:
+            f.write("name: mashine\n")
+        os.utime(self.machine_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        config = machines.load_machine_config(self.machine_file)
+        self.assertEqual(config, {"content": "name: mashine\n"})
+        self.assertEqual(len(self.resolved), 3)
+
+        machines.esm_parser_version = lambda: "2.0"
+        machines.load_machine_config(self.machine_file)
+        self.assertEqual(len(self.resolved), 4)
+
+        machines.load_machine_config(self.machine_file)
+        self.assertEqual(len(self.resolved), 4)
+
+
+class TestSetupCache(unittest.TestCase):
+    """Tests for the ``SETUP_CONFIG_CACHE`` of ``load_setup_config``."""
+
+    def setUp(self):
+        """
+        Load a temporary setup file with a minimal ``esm_parser``. The setup file
+        attaches a file that only ``esm_parser.look_for_file`` finds, which attaches
+        another one next to it.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        for folder in ["setups", "elsewhere", "functions"]:
+            os.mkdir(os.path.join(self.tmpdir, folder))
+        self.setup_file = os.path.join(self.tmpdir, "setups", "awicm-3.1.yaml")
+        self.attachment_file = os.path.join(self.tmpdir, "elsewhere", "further.yaml")
+        self.nested_file = os.path.join(self.tmpdir, "elsewhere", "nested.yaml")
+        self.contents = {
+            self.setup_file: {
+                "general": {"version": "3.1"},
+                "further_reading": ["further.yaml"],
+            },
+            self.attachment_file: {"further_reading": "nested.yaml"},
+            self.nested_file: {"fesom": {"version": "2.0"}},
+        }
+        for path in self.contents:
+            with open(path, "w") as f:
+                f.write("general: {}\n")
+        self.lookup = {
+            "awicm-3.1": self.setup_file,
+            "further.yaml": self.attachment_file,
+        }
+
+        self.loaded = []
+
+        def yaml_file_to_dict(path):
+            self.loaded.append(path)
+            return copy.deepcopy(self.contents[path])
+
+        def look_for_file(setup, name):
+            path = self.lookup.get(name)
+            return path, bool(path)
+
+        def attach_to_config_and_remove(config, attachment):
+            if isinstance(config, dict):
+                config.pop(attachment, None)
+
+        esm_parser = types.ModuleType("esm_parser")
+        esm_parser.look_for_file = look_for_file
+        esm_parser.yaml_file_to_dict = yaml_file_to_dict
+        esm_parser.attach_to_config_and_remove = attach_to_config_and_remove
+        esm_parser.CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE = ["further_reading"]
+        esm_rcfile = types.ModuleType("esm_rcfile")
+        esm_rcfile.FUNCTION_PATH = os.path.join(self.tmpdir, "functions")
+        self.modules = mock.patch.dict(
+            sys.modules, {"esm_parser": esm_parser, "esm_rcfile": esm_rcfile}
+        )
+        self.modules.start()
+        setups.SETUP_CONFIG_CACHE.clear()
+
+    def tearDown(self):
+        self.modules.stop()
+        setups.SETUP_CONFIG_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, path):
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def setup_loads(self):
+        return self.loaded.count(self.setup_file)
+
+    def test_cache(self):
+        """Test that the setup file is loaded once per ``setup`` and ``version``."""
+        config = setups.load_setup_config("awicm", "3.1")
+        self.assertEqual(config, {"general": {"version": "3.1"}})
+        self.assertIs(setups.load_setup_config("awicm", "3.1"), config)
+        self.assertEqual(self.setup_loads(), 1)
+
+        self.lookup["awicm-3.2"] = self.setup_file
+        setups.load_setup_config("awicm", "3.2")
+        self.assertEqual(self.setup_loads(), 2)
+
+    def test_invalidation(self):
+        """
+        Test that changes in the setup file or in any attachment file, including
+        the nested ones, invalidate the cache.
+        """
+        config = setups.load_setup_config("awicm", "3.1")
+
+        self.touch(self.setup_file)
+        reloaded = setups.load_setup_config("awicm", "3.1")
+        self.assertIsNot(reloaded, config)
+        self.assertEqual(self.setup_loads(), 2)
+
+        for path, loads in [(self.attachment_file, 3), (self.nested_file, 4)]:
+            self.touch(path)
+            setups.load_setup_config("awicm", "3.1")
+            self.assertEqual(self.setup_loads(), loads)
+
+        setups.load_setup_config("awicm", "3.1")
+        self.assertEqual(self.setup_loads(), 4)
+
+    def test_missing_attachment(self):
+        """Test that setups with attachments that cannot be located are not cached."""
+        self.contents[self.setup_file]["further_reading"] = ["missing.yaml"]
+        for _ in range(2):
+            setups.load_setup_config("awicm", "3.1")
+        self.assertEqual(self.setup_loads(), 2)
+        self.assertEqual(len(setups.SETUP_CONFIG_CACHE), 0)
+
+
+class TestResolveVariables(unittest.TestCase):
+    """Tests for ``resolve_variables``."""
+
+    def test_resolve_variables(self):
+        """
+        Test that an environment with variables is resolved as the root of the
+        traversal, so that unqualified variables (e.g. ``${version}``) are looked up
+        as in the original per-model resolution, and that the rest are skipped.
+        """
+        calls = []
+        esm_parser = types.ModuleType("esm_parser")
+        esm_parser.find_variable = object()
+        esm_parser.recursive_run_function = lambda *args: calls.append(args)
+
+        environment = {"add_export_vars": {"FESOM_VERSION": "${version}"}}
+        complete_config = {"fesom": {"version": "2.0"}}
+        with mock.patch.dict(sys.modules, {"esm_parser": esm_parser}):
+            esm_environment.resolve_variables(environment, complete_config)
+            esm_environment.resolve_variables(
+                {"add_module_actions": ["load netcdf"]}, complete_config
+            )
+
+        self.assertEqual(len(calls), 1)
+        tree, root, level, function, config = calls[0][:5]
+        self.assertEqual(tree, [])
+        self.assertIs(root, environment)
+        self.assertEqual(level, "atomic")
+        self.assertIs(function, esm_parser.find_variable)
+        self.assertIs(config, complete_config)
+
+
+class TestMachineIndex(unittest.TestCase):
+    """Tests for the hostname-to-machine index."""
+
+    def setUp(self):
+        """Write an ``all_machines.yaml`` and use a temporary cache directory."""
+        if importlib.util.find_spec("esm_parser") is None:
+            self.skipTest("esm_parser is needed to read the machine files")
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.machines_dir = os.path.join(self.tmpdir, "machines")
+        os.mkdir(self.machines_dir)
+        with open(os.path.join(self.machines_dir, "all_machines.yaml"), "w") as f:
+            f.write(
+                "levante:\n"
+                "    login_nodes: 'levante*'\n"
+                "    compute_nodes: ['l[0-9]{5}']\n"
+                "albedo:\n"
+                "    login_nodes: 'albedo[0-1]'\n"
+            )
+        self.environ = dict(os.environ)
+        os.environ["ESM_ENVIRONMENT_CACHE_DIR"] = os.path.join(self.tmpdir, "cache")
+        machines.MACHINE_INDEXES.clear()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        machines.MACHINE_INDEXES.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_machine_file(self):
+        """Test that hosts are matched and remembered in the index on disk."""
+        self.assertEqual(
+            machines.find_machine_file(self.machines_dir, "l10432"),
+            self.machines_dir + "/levante.yaml",
+        )
+        self.assertEqual(
+            machines.find_machine_file(self.machines_dir, "albedo1"),
+            self.machines_dir + "/albedo.yaml",
+        )
+        machines.MACHINE_INDEXES.clear()
+        index = machines.load_machine_index(self.machines_dir)
+        self.assertEqual(sorted(index["hosts"]), ["albedo1", "l10432"])
+
+        # Changing the machines invalidates the index
+        os.utime(self.machines_dir, ns=(0, 0))
+        index = machines.load_machine_index(self.machines_dir)
+        self.assertEqual(index["hosts"], {})
+
+
+class TestLock(unittest.TestCase):
+    """Tests for ``EnvironmentInfos.to_lock`` and ``EnvironmentInfos.from_lock``."""
+
+    def setUp(self):
+        """Define a configuration with a ``computer`` section."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.complete_config = {
+            "computer": {
+                "sh_interpreter": "/bin/bash",
+                "module_actions": ["purge", "load intel"],
+                "export_vars": {"CC": "icc"},
+            },
+            "fesom": {
+                "version": "2.0",
+                "environment_changes": {
+                    "add_export_vars": ["PATH=$PATH:/opt", "PATH=$PATH:/opt"],
+                },
+            },
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lock(self):
+        """Test that locks reproduce the environment and stale locks are rejected."""
+        if importlib.util.find_spec("esm_parser") is None:
+            self.skipTest("esm_parser is needed to build the environments")
+
+        path = os.path.join(self.tmpdir, "environment.lock")
+        env = esm_environment.EnvironmentInfos(
+            "runtime", self.complete_config, "fesom"
+        )
+        # The fingerprint of the inputs is taken when the environment is built
+        self.complete_config["fesom"]["version"] = "2.1"
+        env.to_lock(path)
+        self.complete_config["fesom"]["version"] = "2.0"
+
+        locked = esm_environment.EnvironmentInfos.from_lock(
+            path, "runtime", self.complete_config, "fesom"
+        )
+        self.assertEqual(locked.commands, env.commands)
+        self.assertEqual(
+            export_records(locked.config["export_vars"]),
+            export_records(env.config["export_vars"]),
+        )
+        # The commands are generated again from the loaded config
+        locked.reset_commands()
+        self.assertEqual(locked.commands, env.commands)
+
+        self.complete_config["fesom"]["version"] = "2.1"
+        with self.assertRaises(ValueError):
+            esm_environment.EnvironmentInfos.from_lock(
+                path, "runtime", self.complete_config, "fesom"
+            )
+
+    def test_machine_file(self):
+        """
+        Test that the stale check of a lock built from a machine file uses that
+        file, and not the machine file of this host.
+        """
+        machine_file = os.path.join(self.tmpdir, "machine.yaml")
+        with open(machine_file, "w") as f:
+            f.write("name: machine\n")
+        path = os.path.join(self.tmpdir, "environment.lock")
+        machine_config = copy.deepcopy(self.complete_config["computer"])
+
+        def find_machine_file():
+            raise AssertionError("The machine file of this host was looked up")
+
+        with mock.patch.multiple(
+            machines,
+            load_machine_config=lambda machine_file: copy.deepcopy(machine_config),
+            find_machine_file=find_machine_file,
+        ):
+            env = esm_environment.EnvironmentInfos(
+                "compiletime", {}, machine_file=machine_file
+            )
+            env.to_lock(path)
+            locked = esm_environment.EnvironmentInfos.from_lock(
+                path, "compiletime", {}
+            )
+            self.assertEqual(locked.commands, env.commands)
+            self.assertEqual(locked.fingerprint, env.fingerprint)
+
+            with open(machine_file, "a") as f:
+                f.write("compiler: gcc\n")
+            with self.assertRaises(ValueError):
+                esm_environment.EnvironmentInfos.from_lock(path, "compiletime", {})
+
+
+class TestEnsemble(unittest.TestCase):
+    """Tests for the structural sharing of ``EnvironmentInfos.ensemble``."""
+
+    def test_share_structure(self):
+        """Test that equal subtrees and ``ExportVar`` keys are taken from the base."""
+        record = esm_environment.ExportVar("PATH", "$PATH:/opt")
+        base = {
+            "module_actions": ["purge", "load intel"],
+            "export_vars": {"CC": "icc", record: "PATH=$PATH:/opt"},
+        }
+        new = copy.deepcopy(base)
+        new["export_vars"]["FC"] = "ifort"
+
+        shared = esm_environment.share_structure(base, new)
+        self.assertEqual(shared["export_vars"], new["export_vars"])
+        self.assertEqual(
+            export_records(shared["export_vars"]), export_records(new["export_vars"])
+        )
+        self.assertIs(shared["module_actions"], base["module_actions"])
+        self.assertIsNot(shared["export_vars"], base["export_vars"])
+        self.assertIs(list(shared["export_vars"])[1], record)
+        self.assertIs(esm_environment.share_structure(base, copy.deepcopy(base)), base)
+
+    def test_share_structure_repeated_records(self):
+        """Test that records with equal names and values are not merged."""
+        records = [
+            esm_environment.ExportVar("A", "1", "fesom", 0),
+            esm_environment.ExportVar("A", "1", "fesom", 1),
+            esm_environment.ExportVar("A", "1", "echam", 0),
+        ]
+        base = {records[0]: "A=1", "CC": "icc", records[1]: "A=1"}
+        new = {records[2]: "A=1", "CC": "icc", records[1]: "A=1", "FC": "ifort"}
+
+        shared = esm_environment.share_structure(base, copy.deepcopy(new))
+        self.assertEqual(export_records(shared), export_records(new))
+        self.assertEqual(list(shared.values()), ["A=1", "icc", "A=1", "ifort"])
+        # Only the record with the same fields is taken from the base
+        self.assertIs(list(shared)[2], records[1])
+        self.assertIsNot(list(shared)[0], records[0])
+
+    def test_ensemble(self):
+        """Test that the members match the environments built independently."""
+        if importlib.util.find_spec("esm_parser") is None:
+            self.skipTest("esm_parser is needed to build the environments")
+
+        computer = {
+            "sh_interpreter": "/bin/bash",
+            "module_actions": ["purge", "load intel"],
+            "export_vars": {"CC": "icc"},
+        }
+        members = {}
+        for member, value in enumerate(["1", "2", "1"]):
+            members[member] = {
+                "computer": copy.deepcopy(computer),
+                "fesom": {"environment_changes": {"add_export_vars": [f"A={value}"]}},
+            }
+        environments = esm_environment.EnvironmentInfos.ensemble(
+            "runtime", members, "fesom"
+        )
+        for member, complete_config in members.items():
+            env = esm_environment.EnvironmentInfos("runtime", complete_config, "fesom")
+            self.assertEqual(environments[member].commands, env.commands)
+        self.assertIs(
+            environments[1].config["module_actions"],
+            environments[0].config["module_actions"],
+        )
+        self.assertIs(environments[2].config, environments[0].config)
+
+
+class TestDelta(unittest.TestCase):
+    """Tests for ``EnvironmentInfos.delta``."""
+
+    def environment(self, module_actions, export_vars, unset_vars=()):
+        """Returns an ``EnvironmentInfos`` with the given resolved config."""
+        environment = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        environment.config = {
+            "module_actions": module_actions,
+            "export_vars": export_vars,
+            "unset_vars": list(unset_vars),
+        }
+        return environment
+
+    def test_module_actions(self):
+        """Test that new module actions are emitted with all the exports."""
+        loaded = self.environment(["purge", "load intel"], {"CC": "icc"})
+        target = self.environment(
+            ["purge", "load intel", "load netcdf"], {"CC": "icc"}
+        )
+        self.assertEqual(
+            target.delta_commands(loaded),
+            ["module load netcdf", "", "export CC=icc", ""],
+        )
+        target = self.environment(["purge", "load gcc"], {"CC": "gcc"})
+        result = target.delta(loaded)
+        self.assertFalse(result["incremental"])
+        self.assertEqual(result["commands"], target.commands)
+
+    def test_exports(self):
+        """Test that the delta reproduces the target exports in a shell."""
+        loaded = self.environment(
+            [], {"CC": "icc", "A": "1", "PATH": "$PATH:/a", "X": "1"}, ["Y"]
+        )
+        target = self.environment([], {"CC": "icc", "A": "2", "B": "3"}, ["Y", "Z"])
+        result = target.delta(loaded)
+        self.assertEqual(result["export_vars"]["added"], ["export A=2", "export B=3"])
+        self.assertEqual(result["leaked"], ["PATH", "X"])
+        self.assertEqual(
+            target.delta_commands(loaded, unset_leaked=True),
+            ["", "export A=2", "export B=3", "", "unset PATH", "unset X", "unset Z"],
+        )
+
+        # Exports referencing a variable changed by the loaded environment
+        target = self.environment([], {"CC": "icc", "A": "1", "PATH": "$PATH:/b"})
+        self.assertEqual(
+            target.delta_commands(loaded),
+            ["", "export CC=icc", "export A=1", "export PATH=$PATH:/b", ""],
+        )
+
+    def test_exports_overwritten_after_prefix(self):
+        """
+        Test that the common exports are emitted again if the loaded environment
+        changed them after the common prefix.
+        """
+        loaded = self.environment([], {"A": "1", "B": "2", "A[(1)]": "5"})
+        target = self.environment([], {"A": "1", "B": "3"})
+        self.assertEqual(
+            target.delta_commands(loaded), ["", "export A=1", "export B=3", ""]
+        )
+
+        loaded = self.environment([], {"A": "1", "A[(1)]": "2"})
+        target = self.environment([], {"A": "1"})
+        self.assertEqual(target.delta_commands(loaded), ["", "export A=1", ""])
+
+
+class TestSlim(unittest.TestCase):
+    """Tests for ``EnvironmentInfos.slim``."""
+
+    def test_slim(self):
+        """Test that only the environment entries are kept and commands still work."""
+        env = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        env.config = {
+            "sh_interpreter": "/bin/bash",
+            "module_actions": ["purge"],
+            "export_vars": {"MODEL_DIR": "${model_dir}/bin"},
+            "partitions": {"compute": {"name": "compute", "cores_per_node": 128}},
+            "launcher": "srun",
+        }
+        commands = env.commands
+        env.slim()
+
+        self.assertIsInstance(env.config, esm_environment.ResolvedEnvironment)
+        self.assertEqual(
+            env.config.to_dict(),
+            {
+                "module_actions": ["purge"],
+                "export_vars": {"MODEL_DIR": "${model_dir}/bin"},
+                "sh_interpreter": "/bin/bash",
+            },
+        )
+        self.assertNotIn("launcher", env.config)
+        self.assertNotIn("unset_vars", env.config)
+        self.assertIs(env.commands, commands)
+        with self.assertRaises(KeyError):
+            env.config["launcher"] = "mpirun"
+        # Only the entries are items, not the methods
+        for key in ["keys", "get", "items", "to_dict", "unset_vars"]:
+            with self.assertRaises(KeyError):
+                env.config[key]
+            with self.assertRaises(KeyError):
+                del env.config[key]
+
+        env.replace_model_dir("/work/fesom")
+        self.assertIn("export MODEL_DIR=/work/fesom/bin", env.commands)
+
+
+class TestPlaceholderTemplate(unittest.TestCase):
+    """Tests for ``PlaceholderTemplate``."""
+
+    def test_substitute_tree(self):
+        """Test that keys and values are substituted keeping the structure."""
+        record = esm_environment.ExportVar("PATH", "${model_dir}/bin:$PATH")
+        template = esm_environment.PlaceholderTemplate(
+            {"model_dir": "/work/fesom", "model": "fesom", "work_dir": "/scratch"}
+        )
+        export_vars = {
+            "FESOM_DIR": "${model_dir}",
+            "${model}_WORK": "${work_dir}/${model}-${unknown}",
+            record: "PATH=${model_dir}/bin:$PATH",
+            "AWI_FESOM_YAML": {"output_schedules": ["${work_dir}/out"]},
+            "NPROC": 4,
+        }
+        self.assertEqual(
+            list(template.substitute_tree(export_vars).items()),
+            [
+                ("FESOM_DIR", "/work/fesom"),
+                ("fesom_WORK", "/scratch/fesom-${unknown}"),
+                (record, "PATH=/work/fesom/bin:$PATH"),
+                ("AWI_FESOM_YAML", {"output_schedules": ["/scratch/out"]}),
+                ("NPROC", 4),
+            ],
+        )
+
+
+class TestSharedEnvironment(unittest.TestCase):
+    """Tests for the shared environment files sourced by the scripts."""
+
+    def setUp(self):
+        # Paths with spaces must be quoted in the scripts
+        self.tmpdir = tempfile.mkdtemp(prefix="esm env ")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_scripts(self):
+        """Test that the scripts source one environment file with the commands."""
+        env = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        env.config = {"sh_interpreter": "/bin/bash", "export_vars": {"A": "1"}}
+        paths = env.write_scripts(
+            {"comp_a": ["echo $A"], "comp_b": ["echo $A$A"]},
+            directory=self.tmpdir,
+            shared_environment=True,
+        )
+
+        environment_files = [
+            name for name in os.listdir(self.tmpdir) if name.startswith("esm_env")
+        ]
+        self.assertEqual(environment_files, [env.environment_file_name()])
+        environment_file = os.path.join(self.tmpdir, environment_files[0])
+        with open(paths["comp_a"]) as f:
+            self.assertIn(f"source '{environment_file}'\n", f.read())
+        output = subprocess.run(
+            ["bash", paths["comp_b"]], stdout=subprocess.PIPE, check=True
+        ).stdout
+        self.assertEqual(output.decode().strip(), "11")
+
+        # A different environment gets its own file
+        env.config["export_vars"]["A"] = "2"
+        env.reset_commands()
+        self.assertNotEqual(
+            env.write_environment_file(self.tmpdir), environment_file
+        )
+
+
+class TestMemoize(unittest.TestCase):
+    """Tests for ``EnvironmentInfos(..., memoize=True)`` and ``ENVIRONMENT_CACHE``."""
+
+    def setUp(self):
+        """Resolve a fixed machine config, without the on-disk caches."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.machine_file = os.path.join(self.tmpdir, "machine.yaml")
+        with open(self.machine_file, "w") as f:
+            f.write("name: machine\n")
+        self.machine_config = {
+            "sh_interpreter": "/bin/bash",
+            "module_actions": ["purge", "load intel", "load intel"],
+            "export_vars": {"CC": "icc"},
+        }
+        self.environ = dict(os.environ)
+        os.environ["ESM_ENVIRONMENT_NO_CACHE"] = "1"
+        self.resolve_machine_file = machines.resolve_machine_file
+        machines.resolve_machine_file = lambda machine_file: copy.deepcopy(
+            self.machine_config
+        )
+        esm_environment.ENVIRONMENT_CACHE.clear()
+
+    def tearDown(self):
+        machines.resolve_machine_file = self.resolve_machine_file
+        esm_environment.ENVIRONMENT_CACHE.clear()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, **kwargs):
+        return esm_environment.EnvironmentInfos(
+            "compiletime", {}, machine_file=self.machine_file, memoize=True, **kwargs
+        )
+
+    def test_optimize(self):
+        """Test that optimized and plain environments are memoized separately."""
+        optimized = self.build(optimize=True)
+        self.assertEqual(optimized.config["module_actions"], ["purge", "load intel"])
+
+        plain = self.build()
+        self.assertEqual(
+            plain.config["module_actions"], ["purge", "load intel", "load intel"]
+        )
+        self.assertFalse(hasattr(plain, "optimization_report"))
+
+        memoized = self.build(optimize=True)
+        self.assertEqual(memoized.commands, optimized.commands)
+        self.assertEqual(memoized.optimization_report, optimized.optimization_report)
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.hits, 1)
+
+    def test_hits_and_invalidation(self):
+        """Test that identical inputs hit the cache and changed inputs miss it."""
+        first = self.build()
+        second = self.build()
+        self.assertEqual(second.commands, first.commands)
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.hits, 1)
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.misses, 1)
+
+        # A different operation
+        esm_environment.EnvironmentInfos(
+            "runtime", {}, machine_file=self.machine_file, memoize=True
+        )
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.misses, 2)
+
+        # An edited machine file
+        self.machine_config["export_vars"] = {"CC": "gcc"}
+        with open(self.machine_file, "a") as f:
+            f.write("compiler: gcc\n")
+        edited = self.build()
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.misses, 3)
+        self.assertIn("export CC=gcc", edited.commands)
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.hits, 1)
+
+    def test_hostname_machine_file(self):
+        """Test that the machine file found from the hostname is fingerprinted."""
+
+        def build():
+            return esm_environment.EnvironmentInfos("compiletime", {}, memoize=True)
+
+        with mock.patch.object(
+            machines, "find_machine_file", lambda: self.machine_file
+        ):
+            first = build()
+            self.assertEqual(first.machine_file, self.machine_file)
+            self.assertEqual(build().commands, first.commands)
+            self.assertEqual(esm_environment.ENVIRONMENT_CACHE.hits, 1)
+
+            self.machine_config["export_vars"] = {"CC": "gcc"}
+            with open(self.machine_file, "a") as f:
+                f.write("compiler: gcc\n")
+            edited = build()
+        self.assertIn("export CC=gcc", edited.commands)
+        self.assertEqual(esm_environment.ENVIRONMENT_CACHE.hits, 1)
+
+    def test_fingerprint(self):
+        """Test which parts of the config change ``environment_fingerprint``."""
+        config = {
+            "computer": {"module_actions": ["load intel"]},
+            "fesom": {"version": "2.0", "environment_changes": {}, "lresume": False},
+        }
+        fingerprint = esm_environment.environment_fingerprint("compiletime", config)
+
+        unrelated = copy.deepcopy(config)
+        unrelated["fesom"]["lresume"] = True
+        self.assertEqual(
+            esm_environment.environment_fingerprint("compiletime", unrelated),
+            fingerprint,
+        )
+
+        for chapter, key, value in [
+            ("computer", "module_actions", ["load gcc"]),
+            ("fesom", "version", "2.1"),
+            ("fesom", "environment_changes", {"export_vars": {"CC": "gcc"}}),
+        ]:
+            changed = copy.deepcopy(config)
+            changed[chapter][key] = value
+            self.assertNotEqual(
+                esm_environment.environment_fingerprint("compiletime", changed),
+                fingerprint,
+            )
+
+    def test_tree_hash(self):
+        """Test that ``tree_hash`` is order-sensitive and rejects unstable values."""
+        tree = ("compiletime", {"computer": {"a": [1, "2"], "b": {"c": None}}})
+        for depth in [None, 0, 1, 2, 3]:
+            self.assertEqual(
+                cache.tree_hash(tree, depth),
+                cache.tree_hash(copy.deepcopy(tree), depth),
+            )
+        self.assertNotEqual(
+            cache.tree_hash({"a": 1, "b": 2}), cache.tree_hash({"b": 2, "a": 1})
+        )
+        self.assertNotEqual(
+            cache.tree_hash(("ab", "c")), cache.tree_hash(("a", "bc"))
+        )
+        self.assertIsNone(cache.tree_hash({"a": [object()]}))
+        self.assertIsNone(cache.tree_hash({"a": [object()]}, depth=1))
+
+    def test_lru_cache(self):
+        """Test the counters and the eviction of ``LRUCache``."""
+        lru = cache.LRUCache(maxsize=2)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        self.assertEqual(lru.get("a"), 1)
+        lru.put("c", 3)
+        self.assertNotIn("b", lru)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(
+            lru.info(), {"hits": 1, "misses": 1, "maxsize": 2, "size": 2}
+        )
+        lru.clear()
+        self.assertEqual(
+            lru.info(), {"hits": 0, "misses": 0, "maxsize": 2, "size": 0}
+        )
+
+
+class TestPhaseTimings(unittest.TestCase):
+    """Tests for ``timing.PhaseTimings``."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.timings = timing.PhaseTimings()
+        # Use round start times
+        self.timings._origin = 0.0
+        self.timings.add("load_computer", 0.0, 0.5)
+        self.timings.add("apply_model_changes", 0.5, 0.25, "fesom")
+        self.timings.add("apply_model_changes", 0.75, 0.125, "echam")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_to_json(self):
+        """Test the records and totals in the JSON output."""
+        path = os.path.join(self.tmpdir, "timings.json")
+        data = json.loads(self.timings.to_json(path))
+        with open(path) as f:
+            self.assertEqual(json.load(f), data)
+
+        self.assertEqual(data["records"][1], {
+            "phase": "apply_model_changes",
+            "component": "fesom",
+            "start": 0.5,
+            "duration": 0.25,
+        })
+        self.assertEqual(data["totals"], {
+            "load_computer": 0.5,
+            "apply_model_changes": 0.375,
+            "apply_model_changes/fesom": 0.25,
+            "apply_model_changes/echam": 0.125,
+        })
+
+    def test_to_chrome_trace(self):
+        """Test the complete events of the Chrome trace output."""
+        path = os.path.join(self.tmpdir, "trace.json")
+        data = json.loads(self.timings.to_chrome_trace(path))
+        with open(path) as f:
+            self.assertEqual(json.load(f), data)
+
+        events = data["traceEvents"]
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[2], {
+            "name": "apply_model_changes",
+            "cat": "esm_environment",
+            "ph": "X",
+            "ts": 0.75e6,
+            "dur": 0.125e6,
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": {"component": "echam"},
+        })
+
+    def test_environment_phases(self):
+        """Test the phases recorded by ``EnvironmentInfos`` and the callbacks."""
+        machine_file = os.path.join(self.tmpdir, "machine.yaml")
+        machine_config = {"module_actions": ["load intel"], "export_vars": {}}
+        records = []
+        with mock.patch.object(
+            machines,
+            "load_machine_config",
+            lambda machine_file: copy.deepcopy(machine_config),
+        ):
+            esm_environment.EnvironmentInfos(
+                "compiletime", {}, machine_file=machine_file, timings=records.append
+            )
+        self.assertEqual(
+            [record["phase"] for record in records],
+            ["copy_config", "load_computer", "general_environment"],
+        )
+
+
+class TestCommands(unittest.TestCase):
+    """Tests for the ``commands`` snapshot of ``EnvironmentInfos``."""
+
+    def test_snapshot(self):
+        """Test that commands change only through the API or ``reset_commands``."""
+        env = esm_environment.EnvironmentInfos.__new__(
+            esm_environment.EnvironmentInfos
+        )
+        env.config = {"export_vars": {"A": "1", "B": "${model_dir}"}}
+        self.assertIn("export A=1", env.commands)
+
+        # Direct changes are not detected, regardless of the length of the entries
+        env.config["export_vars"]["A"] = "2"
+        env.config["export_vars"]["C"] = "3"
+        self.assertIn("export A=1", env.commands)
+        self.assertNotIn("export C=3", env.commands)
+        env.reset_commands()
+        self.assertIn("export A=2", env.commands)
+        self.assertIn("export C=3", env.commands)
+
+        # Methods modifying the config discard the snapshot
+        env.replace_model_dir("/work")
+        self.assertIn("export B=/work", env.commands)
+        env.add_esm_var()
+        self.assertIn("export ENVIRONMENT_SET_BY_ESMTOOLS=TRUE", env.commands)